@@ -0,0 +1,65 @@
+# Checks of the BILL client (bill.py) against the fake BILL server: replies
+# are matched to their queries and only complete lines count as replies,
+# pipelined queries share one connection, and a connection the server has hung
+# up on is replaced, sending the queries again only if that can not charge a
+# user twice.
+#
+# Run from the repository root:  python3 -m bench.billcheck
+
+import time
+
+from bench.fakes import FakeBILLServer
+from bench.run import free_port
+from bill import BILLClient
+
+
+def check(name, condition):
+    print(("ok      " if condition else "FAILED  ")+name)
+    return condition
+
+
+def main():
+    port = free_port()
+    server = FakeBILLServer(port=port, credits=100, max_queries=3).start()
+    client = BILLClient("127.0.0.1", port, max_connections=1, timeout=2)
+    results = []
+
+    results.append(check("balance is read", client.get_credits("12") == 100))
+    results.append(check("\".\" is answered as None", client.query("102,12,0,0000") is None))
+    client.clear()   # The pipeline below gets a connection of its own, which the server hangs up after it
+    results.append(check("pipelined replies come in query order",
+                         client.query_many(["602,3,12,0,0", "702,3,12,0,0,-5", "602,3,12,0,0"]) == ["100", "95", "95"]))
+
+    # The server hung up after its third query, the next read goes out again on a new connection
+    time.sleep(0.1)
+    results.append(check("read is sent again after a hang up", client.get_credits("12") == 95))
+    client.query_many(["602,3,12,0,0", "602,3,12,0,0"])
+
+    # Same for a debit: it must fail rather than be sent twice
+    time.sleep(0.1)
+    debits = server.calls["702"]
+    try:
+        client.consume_credit("12", 5)
+        failed = False
+    except OSError:
+        failed = True
+    results.append(check("debit is not sent again after a hang up", failed and server.calls["702"] == debits))
+    results.append(check("balance is unchanged", client.get_credits("12") == 95))
+
+    # A reply cut off mid-line must not be read as a shorter one
+    server.mode = "cut"
+    try:
+        client.get_credits("12")
+        failed = False
+    except ConnectionError:
+        failed = True
+    results.append(check("reply cut off by a hang up is an error", failed))
+    server.mode = "ok"
+
+    server.shutdown()
+    print("All checks passed" if all(results) else "Some checks FAILED")
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,427 @@
+# Local stand-ins for the upstreams of the jukebox, for benchmarking without a
+# Spotify Premium account, an MPD box or the BILL server:
+#
+# - FakeMPDServer speaks enough of the MPD protocol for main.py (status,
+#   currentsong, add, play, pause, idle, ...) and plays its playlist in real time
+# - FakeBILLServer answers the BILL line protocol queries main.py sends
+# - FakeSpotify replaces the spotipy client and simulates one playback device
+#
+# All of them count the calls they get and can add a fixed latency per call.
+# Setting their mode to "hang" or "drop" simulates an upstream that stops
+# answering or drops connections, see FaultModes.
+
+import random
+import shlex
+import socketserver
+import threading
+import time
+from collections import Counter, deque
+
+import spotipy
+
+
+words = ["love", "night", "dance", "summer", "party", "heart", "fire", "dream", "baby", "light",
+         "girl", "boy", "rain", "sun", "money", "home", "road", "wild", "blue",
+         "midnight", "gold", "river", "city", "star", "kiss", "time", "world", "forever", "tonight"]
+
+def song_title(rng):
+    return " ".join(rng.choice(words).capitalize() for i in range(rng.randint(1, 4)))
+
+
+class CallCounter:
+    def __init__(self):
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+
+# Fault injection. In mode "hang" calls block until the mode is set back to
+# "ok"; in mode "drop" servers close connections without answering and the
+# fake Spotify client raises ConnectionError, as requests does. In mode "cut"
+# the fake BILL server hangs up in the middle of a reply.
+class FaultModes:
+    mode = "ok"
+
+    def wait_while_hanging(self):
+        while self.mode == "hang":
+            time.sleep(0.05)
+
+
+class ThreadedServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+
+# Songs in the fake MPD library: dicts with the fields listallinfo returns
+def mpd_library(size, seed=1):
+    rng = random.Random(seed)
+    songs = []
+    for i in range(size):
+        artist = song_title(rng)
+        songs.append({
+            "file": "%s/%s/%04d %s.mp3" % (artist, song_title(rng), i, song_title(rng)),
+            "Last-Modified": "2024-01-01T00:00:00Z",
+            "Artist": artist,
+            "Time": str(rng.randint(120, 360)),
+            "duration": "%d.000" % rng.randint(120, 360),
+        })
+    return songs
+
+
+class FakeMPDServer(ThreadedServer, CallCounter, FaultModes):
+    def __init__(self, host="127.0.0.1", port=6600, library_size=5000, latency=0, track_seconds=None):
+        CallCounter.__init__(self)
+        self.latency = latency
+        self.track_seconds = track_seconds   # Play every song this long instead of its real duration
+        self.library = mpd_library(library_size)
+        self.by_file = {song['file']: song for song in self.library}
+        self.state_lock = threading.Condition()
+        self.events = 0       # Bumped on every player change, wakes idle connections
+        self.playlist = []    # Files, the first one is the current song when playing or paused
+        self.state = "stop"
+        self.started = 0      # time.monotonic() the current song would have started if it never paused
+        self.paused_at = None
+        self.volume = 50
+        super().__init__((host, port), FakeMPDHandler)
+
+    def duration(self, file):
+        return self.track_seconds or float(self.by_file.get(file, {}).get("duration", 180))
+
+    def changed(self):
+        self.events += 1
+        self.state_lock.notify_all()
+
+    # Move on to the next songs if the current one has ended. Call with state_lock held.
+    def advance(self):
+        while self.state == "play" and self.playlist and time.monotonic() - self.started >= self.duration(self.playlist[0]):
+            self.started += self.duration(self.playlist.pop(0))   # consume mode
+            self.changed()
+        if self.state == "play" and not self.playlist:
+            self.state = "stop"
+            self.changed()
+
+    def elapsed(self):
+        if self.state == "pause":
+            return self.paused_at - self.started
+        return time.monotonic() - self.started
+
+    def song(self, file):
+        song = self.by_file.get(file, {"file": file, "duration": "180.000"})
+        return dict(song, duration="%.3f" % self.duration(file))
+
+    # Response pairs (or ACK error string) for one command
+    def command(self, name, args):
+        self.count(name)
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.state_lock:
+            self.advance()
+            if name in ("ping", "consume", "close"):
+                return []
+            if name == "status":
+                status = [("volume", self.volume), ("repeat", 0), ("random", 0), ("consume", 1),
+                          ("playlistlength", len(self.playlist)), ("state", self.state)]
+                if self.state != "stop" and self.playlist:
+                    status += [("song", 0), ("elapsed", "%.3f" % self.elapsed()),
+                               ("duration", "%.3f" % self.duration(self.playlist[0]))]
+                return status
+            if name == "currentsong":
+                return list(self.song(self.playlist[0]).items()) if self.state != "stop" and self.playlist else []
+            if name == "playlistinfo":
+                return [pair for file in self.playlist for pair in self.song(file).items()]
+            if name == "listallinfo":   # Songs below the directory in args, or all
+                return [pair for song in self.library if not args or song['file'].startswith(args[0].rstrip("/")+"/") for pair in song.items()]
+            if name == "search":
+                query = args[-1].lower()
+                return [pair for song in self.library if query in song['file'].lower() for pair in song.items()]
+            if name == "add":
+                self.playlist.append(args[0])
+                self.changed()
+                return []
+            if name == "play":
+                if self.playlist and self.state != "play":
+                    self.state = "play"
+                    self.started = time.monotonic()
+                    self.changed()
+                return []
+            if name == "pause":
+                if args and args[0] == "1" and self.state == "play":
+                    self.state = "pause"
+                    self.paused_at = time.monotonic()
+                    self.changed()
+                elif args and args[0] == "0" and self.state == "pause":
+                    self.state = "play"
+                    self.started += time.monotonic() - self.paused_at
+                    self.changed()
+                return []
+            if name == "previous":
+                self.started = time.monotonic()
+                self.changed()
+                return []
+            if name == "setvol":
+                self.volume = int(args[0])
+                self.changed()
+                return []
+        return "ACK [5@0] {%s} unknown command \"%s\"" % (name, name)
+
+    # Block until one of the subsystems changes, returns the idle response pairs.
+    # Only the player ever changes here.
+    def idle(self, subsystems):
+        self.count("idle")
+        with self.state_lock:
+            events = self.events
+            while self.events == events or (subsystems and "player" not in subsystems):
+                self.advance()
+                if self.events != events and (not subsystems or "player" in subsystems):
+                    break
+                timeout = None
+                if self.state == "play" and self.playlist:   # Wake up when the song ends
+                    timeout = max(0.01, self.duration(self.playlist[0]) - (time.monotonic() - self.started))
+                self.state_lock.wait(timeout)
+        return [("changed", "player")]
+
+
+class FakeMPDHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.wait_while_hanging()
+        if self.server.mode == "drop":
+            return
+        self.wfile.write(b"OK MPD 0.23.5\n")
+        for line in self.rfile:
+            parts = shlex.split(line.decode("utf-8"))
+            if not parts:
+                continue
+            self.server.wait_while_hanging()
+            if self.server.mode == "drop":
+                return
+            if parts[0] == "close":
+                return
+            if parts[0] == "idle":
+                response = self.server.idle(parts[1:])
+            else:
+                response = self.server.command(parts[0], parts[1:])
+            if isinstance(response, str):
+                self.wfile.write((response+"\n").encode("utf-8"))
+                continue
+            self.wfile.write("".join("%s: %s\n" % pair for pair in response).encode("utf-8") + b"OK\n")
+
+
+class FakeBILLServer(ThreadedServer, CallCounter, FaultModes):
+    def __init__(self, host="127.0.0.1", port=4242, latency=0, credits=1000000, max_queries=None):
+        CallCounter.__init__(self)
+        self.latency = latency
+        self.max_queries = max_queries   # Hang up after this many queries on a connection, like an idle timeout
+        self.initial_credits = credits
+        self.credits = {}
+        self.lock = threading.Lock()
+        super().__init__((host, port), FakeBILLHandler)
+
+    # Response line for one query, "." for none
+    def query(self, line):
+        fields = line.split(",")
+        self.count(fields[0])
+        if self.latency:
+            time.sleep(self.latency)
+
+        if fields[0] == "102" and len(fields) == 4:   # Log in, bill_key and code
+            return "Bench User "+fields[1] if fields[3] == "1234" else "."
+        if fields[0] == "602" and len(fields) == 5:   # Balance
+            with self.lock:
+                return str(self.credits.get(fields[2], self.initial_credits))
+        if fields[0] == "702" and len(fields) == 6:   # Change balance
+            with self.lock:
+                balance = self.credits.get(fields[2], self.initial_credits) + int(fields[5])
+                if balance < 0:
+                    return "."
+                self.credits[fields[2]] = balance
+                return str(balance)
+        return "."
+
+
+class FakeBILLHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        answered = 0
+        for line in self.rfile:
+            self.server.wait_while_hanging()
+            if self.server.mode == "drop":
+                return
+            reply = (self.server.query(line.decode("latin_1").strip())+"\n").encode("latin_1")
+            if self.server.mode == "cut":
+                self.wfile.write(reply[:len(reply)//2])
+                return
+            self.wfile.write(reply)
+            answered += 1
+            if answered == self.server.max_queries:
+                return
+
+
+# Tracks in the fake Spotify catalogue, in the shape spotipy returns them
+def spotify_catalogue(size, seed=2):
+    rng = random.Random(seed)
+    tracks = {}
+    for i in range(size):
+        track_id = "fake%018d" % i
+        tracks[track_id] = {
+            "id": track_id,
+            "uri": "spotify:track:"+track_id,
+            "name": song_title(rng),
+            "artists": [{"name": song_title(rng)}],
+            "album": {"images": [{"url": "static/mp3_icon_600.png", "height": 640},
+                                 {"url": "static/mp3_icon_600.png", "height": 300},
+                                 {"url": "static/mp3_icon_64.png", "height": 64}]},
+            "duration_ms": rng.randint(120, 360)*1000,
+        }
+    return tracks
+
+
+# Stand-in for spotipy.Spotify with one playback device called device_name.
+# With a rate_limit, calls beyond that many per 30 seconds get a 429.
+class FakeSpotify(CallCounter, FaultModes):
+    def __init__(self, device_name, catalogue_size=20000, latency=0, track_seconds=None, rate_limit=None, retry_after=5):
+        super().__init__()
+        self.device_name = device_name
+        self.latency = latency
+        self.track_seconds = track_seconds
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.recent = deque()    # time.monotonic() of calls in the last 30 s
+        self.catalogue = spotify_catalogue(catalogue_size)
+        self.track_list = list(self.catalogue.values())
+        self.state_lock = threading.Lock()
+        self.current = None      # Track playing or paused
+        self.started = 0
+        self.paused_at = None
+        self.upcoming = []       # add_to_queue()d tracks
+        self.volume_percent = 50
+
+    def call(self, name):
+        self.count(name)
+        if self.rate_limit:
+            with self.state_lock:
+                now = time.monotonic()
+                while self.recent and self.recent[0] <= now - 30:
+                    self.recent.popleft()
+                self.recent.append(now)
+                if len(self.recent) > self.rate_limit:
+                    self.count("429")
+                    raise spotipy.SpotifyException(429, -1, "API rate limit exceeded", headers={"Retry-After": str(self.retry_after)})
+        if self.latency:
+            time.sleep(self.latency)
+        self.wait_while_hanging()
+        if self.mode == "drop":
+            raise ConnectionError("Connection aborted: remote end closed connection without response")
+
+    def duration(self, track):
+        return self.track_seconds or track['duration_ms']/1000
+
+    def advance(self):
+        while self.current and self.paused_at is None and time.monotonic() - self.started >= self.duration(self.current):
+            self.started += self.duration(self.current)
+            self.current = self.upcoming.pop(0) if self.upcoming else None
+
+    def track(self, uri):
+        self.call("track")
+        return self.catalogue[uri.split(":")[-1]]
+
+    def tracks(self, tracks, market=None):
+        self.call("tracks")
+        return {"tracks": [self.catalogue.get(uri.split(":")[-1]) for uri in tracks[:50]]}
+
+    # Albums and playlists are runs of the catalogue: "album12" has tracks 120-131
+    def collection(self, collection_id, size):
+        start = int("".join(c for c in collection_id if c.isdigit()) or 0) * 10
+        return self.track_list[start:start+size]
+
+    def album_tracks(self, album_id, limit=50, offset=0, market=None):
+        self.call("album_tracks")
+        tracks = self.collection(album_id, 12)
+        return {"items": tracks[offset:offset+limit], "next": "next" if offset+limit < len(tracks) else None}
+
+    def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, market=None, additional_types=("track", "episode")):
+        self.call("playlist_items")
+        tracks = self.collection(playlist_id, 150)
+        return {"items": [{"track": track} for track in tracks[offset:offset+limit]],
+                "next": "next" if offset+limit < len(tracks) else None}
+
+    def search(self, q, limit=10, offset=0, type="track"):
+        self.call("search")
+        # Deterministic pseudo results: the same query gives the same tracks
+        rng = random.Random(q.lower())
+        matches = rng.sample(self.track_list, min(100, len(self.track_list)))
+        items = matches[offset:offset+limit]
+        return {"tracks": {"items": items, "offset": offset, "limit": limit, "total": len(matches),
+                           "next": "next" if offset+limit < len(matches) else None}}
+
+    def devices(self):
+        self.call("devices")
+        with self.state_lock:
+            self.advance()
+            return {"devices": [{"id": "benchdevice", "name": self.device_name, "is_active": self.current is not None,
+                                 "volume_percent": self.volume_percent}]}
+
+    def current_playback(self):
+        self.call("current_playback")
+        with self.state_lock:
+            self.advance()
+            if not self.current:
+                return None
+            elapsed = (self.paused_at or time.monotonic()) - self.started
+            return {
+                "device": {"id": "benchdevice", "name": self.device_name, "is_active": True, "volume_percent": self.volume_percent},
+                "progress_ms": int(elapsed*1000),
+                "is_playing": self.paused_at is None,
+                "item": dict(self.current, duration_ms=int(self.duration(self.current)*1000)),
+            }
+
+    def queue(self):
+        self.call("queue")
+        with self.state_lock:
+            self.advance()
+            return {"currently_playing": self.current, "queue": list(self.upcoming)}
+
+    def start_playback(self, device_id=None, uris=None, **kwargs):
+        self.call("start_playback")
+        with self.state_lock:
+            self.advance()
+            if uris:
+                self.current = self.catalogue[uris[0].split(":")[-1]]
+                self.started = time.monotonic()
+                self.paused_at = None
+            elif self.current and self.paused_at is not None:
+                self.started += time.monotonic() - self.paused_at
+                self.paused_at = None
+
+    def pause_playback(self, device_id=None):
+        self.call("pause_playback")
+        with self.state_lock:
+            self.advance()
+            if self.current and self.paused_at is None:
+                self.paused_at = time.monotonic()
+
+    def previous_track(self, device_id=None):
+        self.call("previous_track")
+        with self.state_lock:
+            self.started = self.paused_at or time.monotonic()
+
+    def add_to_queue(self, uri, device_id=None):
+        self.call("add_to_queue")
+        with self.state_lock:
+            self.upcoming.append(self.catalogue[uri.split(":")[-1]])
+
+    def volume(self, volume_percent, device_id=None):
+        self.call("volume")
+        self.volume_percent = volume_percent
+
+    def repeat(self, state, device_id=None):
+        self.call("repeat")
+
+    def shuffle(self, state, device_id=None):
+        self.call("shuffle")
@@ -0,0 +1,223 @@
+# Load test of the jukebox against the fake upstreams in bench/fakes.py.
+#
+# Starts a fake MPD server on 6600 and a fake BILL server on 4242, replaces the
+# Spotify client with FakeSpotify and serves make_app() on a local port. Then
+# a number of simulated users search, enqueue tracks and poll /current and
+# /queue like browsers do, for a fixed time. Reports latency percentiles and
+# throughput per endpoint and how many calls each upstream got.
+#
+# With --fault, fake upstreams hang or drop connections for part of the run,
+# to see the deadlines and circuit breakers of upstream.py at work.
+#
+# Run from the repository root:  python3 -m bench.run --users 100 --duration 30
+#                                python3 -m bench.run --fault mpd:hang --fault bill:drop
+
+import argparse
+import asyncio
+import os
+import random
+import socket
+import tempfile
+import time
+import urllib.parse
+from collections import defaultdict
+
+import tornado.httpclient
+import tornado.ioloop
+import tornado.web
+
+from bench.fakes import FakeMPDServer, FakeBILLServer, FakeSpotify, words
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the jukebox against fake Spotify, MPD and BILL upstreams")
+    parser.add_argument("--users", type=int, default=50, help="concurrent simulated users")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to run the load")
+    parser.add_argument("--think-time", type=float, default=0.5, help="mean seconds a user waits between requests")
+    parser.add_argument("--spotify-latency", type=float, default=0.15, help="seconds per Spotify API call")
+    parser.add_argument("--spotify-rate-limit", type=int, help="fake Spotify answers 429 beyond this many calls per 30 s")
+    parser.add_argument("--mpd-latency", type=float, default=0.002, help="seconds per MPD command")
+    parser.add_argument("--bill-latency", type=float, default=0.01, help="seconds per BILL query")
+    parser.add_argument("--library-size", type=int, default=5000, help="songs in the fake MPD library")
+    parser.add_argument("--track-seconds", type=float, default=None, help="play every track this long (default: real durations)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fault", action="append", default=[], metavar="UPSTREAM:MODE",
+                        help="make spotify, mpd or bill hang or drop connections during the run, e.g. mpd:hang")
+    parser.add_argument("--fault-at", type=float, help="seconds into the run when the faults start (default: a third of the duration)")
+    parser.add_argument("--fault-for", type=float, help="seconds the faults last (default: a third of the duration)")
+    parser.add_argument("--output", help="also write the report to this file, e.g. bench_output.txt")
+    return parser.parse_args()
+
+
+# Share of requests per action, roughly what a party night looks like
+actions = [
+    ("current", 40),
+    ("queue", 25),
+    ("search", 10),
+    ("search_all", 5),
+    ("mpdsearch", 5),
+    ("play_track", 6),
+    ("mpd_play_track", 4),
+    ("volume", 5),
+]
+
+
+class LoadGenerator:
+    def __init__(self, base_url, users, think_time, spotify, mpd_songs, seed):
+        self.client = tornado.httpclient.AsyncHTTPClient(max_clients=users)
+        self.base_url = base_url
+        self.users = users
+        self.think_time = think_time
+        self.spotify_ids = list(spotify.catalogue)
+        self.mpd_files = [song['file'] for song in mpd_songs]
+        self.rng = random.Random(seed)
+        self.latencies = defaultdict(list)   # action -> seconds
+        self.errors = defaultdict(int)
+
+    def cookies(self, bill_key):
+        secret = os.environ["TORNADO_COOKIE_SECRET"]
+        user = tornado.web.create_signed_value(secret, "user", bill_key).decode()
+        name = tornado.web.create_signed_value(secret, "name", "Bench User").decode()
+        return "user="+user+"; name="+name
+
+    def request(self, action, rng):
+        query = " ".join(rng.choice(words) for i in range(rng.randint(1, 2)))
+        if action == "current":
+            return "GET", "/current", None
+        if action == "queue":
+            return "GET", "/queue", None
+        if action == "search":
+            return "POST", "/search", query
+        if action == "search_all":
+            return "POST", "/search_all", query
+        if action == "mpdsearch":
+            return "POST", "/mpdsearch", query
+        if action == "play_track":
+            return "GET", "/play_track/"+rng.choice(self.spotify_ids), None
+        if action == "mpd_play_track":
+            return "GET", "/mpd_play_track?url="+urllib.parse.quote(rng.choice(self.mpd_files)), None
+        if action == "volume":
+            return "GET", "/volume/"+str(rng.randint(30, 70)), None
+
+    async def user(self, number, deadline):
+        rng = random.Random(self.rng.random())
+        headers = {"Cookie": self.cookies(str(100+number))}
+        names, weights = zip(*actions)
+        while time.monotonic() < deadline:
+            action = rng.choices(names, weights)[0]
+            method, path, body = self.request(action, rng)
+            start = time.monotonic()
+            try:
+                response = await self.client.fetch(self.base_url+path, method=method, body=body, headers=headers,
+                                                   follow_redirects=False, raise_error=False, request_timeout=60)
+                if response.code >= 400:
+                    self.errors[action] += 1
+            except Exception:
+                self.errors[action] += 1
+            self.latencies[action].append(time.monotonic() - start)
+            await asyncio.sleep(rng.expovariate(1/self.think_time) if self.think_time else 0)
+
+    async def run(self, duration):
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*[self.user(number, deadline) for number in range(self.users)])
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values)*p/100))] if values else 0
+
+
+def report(args, load, duration, fakes, breakers):
+    lines = ["Kakeplay benchmark: %d users, %.0f s, think time %.2f s, latency spotify %.3f s mpd %.3f s bill %.3f s"
+             % (args.users, duration, args.think_time, args.spotify_latency, args.mpd_latency, args.bill_latency)]
+    if args.fault:
+        lines.append("Faults: %s from %.0f s for %.0f s" % (", ".join(args.fault), args.fault_at, args.fault_for))
+    lines.append("")
+    lines.append("%-16s %8s %7s %8s %9s %9s %9s" % ("endpoint", "requests", "errors", "req/s", "p50 ms", "p99 ms", "max ms"))
+    total = 0
+    for action, weight in actions:
+        values = load.latencies[action]
+        total += len(values)
+        lines.append("%-16s %8d %7d %8.1f %9.1f %9.1f %9.1f" % (action, len(values), load.errors[action], len(values)/duration,
+                     percentile(values, 50)*1000, percentile(values, 99)*1000, max(values or [0])*1000))
+    lines.append("%-16s %8d %7d %8.1f" % ("total", total, sum(load.errors.values()), total/duration))
+
+    lines.append("")
+    lines.append("Upstream calls (per second)")
+    for name, fake in fakes:
+        calls = ", ".join("%s %d (%.1f)" % (call, count, count/duration) for call, count in fake.calls.most_common())
+        lines.append("  %-8s %s" % (name, calls or "none"))
+
+    lines.append("")
+    lines.append("Circuit breakers")
+    for name, breaker in breakers.items():
+        lines.append("  %-8s %s, opened %d times, %d calls rejected" % (name, breaker['state'], breaker['opens'], breaker['rejected']))
+
+    text = "\n".join(lines)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text+"\n")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    faults = [fault.split(":") for fault in args.fault]
+    for fault in faults:
+        if len(fault) != 2 or fault[0] not in ("spotify", "mpd", "bill") or fault[1] not in ("hang", "drop"):
+            raise SystemExit("--fault must be spotify, mpd or bill and hang or drop, e.g. mpd:hang")
+    if args.fault_at is None:
+        args.fault_at = args.duration/3
+    if args.fault_for is None:
+        args.fault_for = args.duration/3
+
+    # Configure main.py before importing it, .env does not override these
+    os.environ["MPD_SERVER"] = "127.0.0.1"
+    os.environ["BILLSERVER_HOST"] = "127.0.0.1"
+    os.environ["SPOTIFY_PLAYBACK_DEVICE_NAME"] = "Bench"
+    os.environ["TORNADO_COOKIE_SECRET"] = "bench"
+    os.environ["QUEUE_JOURNAL"] = os.path.join(tempfile.mkdtemp(prefix="kakeplay-bench-"), "queue.journal")
+
+    mpd = FakeMPDServer(library_size=args.library_size, latency=args.mpd_latency, track_seconds=args.track_seconds).start()
+    bill = FakeBILLServer(latency=args.bill_latency).start()
+    spotify = FakeSpotify("Bench", latency=args.spotify_latency, track_seconds=args.track_seconds, rate_limit=args.spotify_rate_limit)
+
+    import main as jukebox
+    jukebox.spotify_login = lambda: spotify
+
+    async def bench():
+        port = free_port()
+        jukebox.start()
+        await jukebox.warm_up()   # Also builds the MPD library index, as it would be long built on a running jukebox
+        jukebox.make_app().listen(port, "127.0.0.1")
+        for fake in (mpd, bill, spotify):
+            fake.calls.clear()
+
+        fakes = {"spotify": spotify, "mpd": mpd, "bill": bill}
+        def set_faults(on):
+            for name, mode in faults:
+                fakes[name].mode = mode if on else "ok"
+                print("Fake", name, "is now", fakes[name].mode)
+        if faults:
+            io_loop = tornado.ioloop.IOLoop.current()
+            io_loop.call_later(args.fault_at, set_faults, True)
+            io_loop.call_later(args.fault_at + args.fault_for, set_faults, False)
+
+        load = LoadGenerator("http://127.0.0.1:%d" % port, args.users, args.think_time, spotify, mpd.library, args.seed)
+        start = time.monotonic()
+        await load.run(args.duration)
+        report(args, load, time.monotonic() - start, [("spotify", spotify), ("mpd", mpd), ("bill", bill)], jukebox.upstream.stats())
+
+    tornado.ioloop.IOLoop.current().run_sync(bench)
+    os._exit(0)   # Don't wait for the MPD watcher and upstream threads
+
+
+if __name__ == "__main__":
+    main()
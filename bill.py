@@ -0,0 +1,164 @@
+# Client for the BILL line protocol on port 4242. Every query is one line and is
+# answered with one line, "." meaning "no result". Connections are kept open and
+# reused, and several queries can be pipelined on one connection.
+
+import socket
+import threading
+import time
+
+import metrics
+
+
+# Queries that only read, and may be sent again if we don't know whether BILL got them
+read_queries = ("102,", "602,")
+
+
+# The queries never reached BILL because no connection could be opened, so
+# they can safely be sent again later
+class BILLNotSent(ConnectionError):
+    pass
+
+
+class BILLConnection:
+    def __init__(self, host, port, timeout):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.buffer = b""
+        self.sent = False      # Whether the current request was handed to the socket
+        self.received = False  # Whether the current request got any reply bytes
+        self.eof = False
+        self.last_used = time.monotonic()
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    # Read one "\n" terminated line, giving up when the deadline has passed
+    def readline(self, deadline):
+        while b"\n" not in self.buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("BILL query timed out")
+            self.sock.settimeout(remaining)
+            data = self.sock.recv(4096)
+            if not data:
+                self.eof = True
+                if self.buffer:   # A reply cut off mid-line, e.g. "15" of "150"
+                    raise ConnectionError("BILL server closed the connection in the middle of a reply")
+                raise ConnectionError("BILL server closed the connection")
+            self.received = True
+            self.buffer += data
+
+        line, _, self.buffer = self.buffer.partition(b"\n")
+        return line
+
+
+class BILLClient:
+    def __init__(self, host, port=4242, max_connections=4, timeout=5, idle_timeout=60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout            # Deadline for a whole query or pipeline, in seconds
+        self.idle_timeout = idle_timeout  # Idle connections older than this are not reused
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def _checkout(self):
+        with self.lock:
+            while self.idle:
+                conn = self.idle.pop()
+                if time.monotonic() - conn.last_used < self.idle_timeout:
+                    return conn
+                conn.close()
+        return None
+
+    def _checkin(self, conn):
+        if conn.eof:
+            conn.close()
+            return
+        conn.last_used = time.monotonic()
+        with self.lock:
+            self.idle.append(conn)
+
+    def _send(self, conn, queries):
+        conn.sent = False
+        conn.received = False
+        conn.sock.settimeout(self.timeout)
+        conn.sock.sendall("".join(query+"\n" for query in queries).encode("latin_1"))
+        conn.sent = True
+
+        deadline = time.monotonic() + self.timeout
+        responses = []
+        for query in queries:
+            line = conn.readline(deadline).decode("latin_1")
+            responses.append(line if line != "." else None)
+        return responses
+
+    # Send all queries on one connection and return their responses in the same order.
+    # A response is None when BILL answered ".".
+    def query_many(self, queries):
+        if not queries:
+            return []
+
+        self.slots.acquire()
+        try:
+            conn = self._checkout()
+            if conn:
+                # A reused connection may have been closed by the server while idle.
+                # The queries are sent again on a new connection if they never left,
+                # or if they only read; a debit that got no reply may still have
+                # been made, so it is not sent twice.
+                try:
+                    responses = self._send(conn, queries)
+                    self._checkin(conn)
+                    return responses
+                except (ConnectionError, OSError) as e:
+                    conn.close()
+                    if isinstance(e, socket.timeout) or conn.received:
+                        raise
+                    if conn.sent and not all(query.startswith(read_queries) for query in queries):
+                        raise
+
+            try:
+                conn = BILLConnection(self.host, self.port, self.timeout)
+            except OSError as e:
+                raise BILLNotSent("Could not connect to BILL: "+str(e)) from e
+            metrics.connected("bill")
+            try:
+                responses = self._send(conn, queries)
+            except Exception:
+                conn.close()
+                raise
+            self._checkin(conn)
+            return responses
+        finally:
+            self.slots.release()
+
+    def query(self, query):
+        return self.query_many([query])[0]
+
+    # Close all idle connections
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    # Credit queries used by the jukebox
+
+    def get_credits(self, bill_key):
+        response = self.query('602,3,'+bill_key+',0,0')
+        return int(response) if response else 0
+
+    # Balances for several users, pipelined on one connection
+    def get_credits_many(self, bill_keys):
+        responses = self.query_many(['602,3,'+bill_key+',0,0' for bill_key in bill_keys])
+        return [int(response) if response else 0 for response in responses]
+
+    def consume_credit(self, bill_key, change):
+        if change == 0:
+            return
+        response = self.query('702,3,'+bill_key+',0,0,'+str(-change))
+        if not response:
+            raise Exception("Debitering av kredit misslyckades")
@@ -0,0 +1,45 @@
+# Small bounded cache with least-recently-used eviction and a time to live.
+# Not thread safe, use it from the IOLoop thread.
+
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, max_size=1000, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()  # key -> (expires, value), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        item = self.items.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self.items[key]
+            self.misses += 1
+            return default
+
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key, value):
+        self.items[key] = (time.monotonic() + self.ttl, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self.items.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        return {"size": len(self.items), "hits": self.hits, "misses": self.misses}
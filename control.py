@@ -0,0 +1,121 @@
+# Volume and media control commands, sent to the players one at a time per
+# player. The volume slider fires a request for every step it is dragged over;
+# volume updates that arrive while one is waiting or in flight replace the
+# waiting one (last write wins), and each waits a short debounce before it is
+# sent, so a drag becomes a few upstream calls instead of dozens.
+#
+# The Spotify device id is cached by DeviceCache and only looked up again when
+# a call made with it fails.
+
+import itertools
+import time
+import traceback
+from collections import OrderedDict
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+
+class DeviceCache:
+    def __init__(self, lookup):
+        self.lookup = lookup     # Coroutine function returning the device id, raises if there is none
+        self.device_id = None
+        self.looking_up = None   # Future of the lookup in progress, shared by concurrent callers
+        self.lookups = 0
+
+    async def get(self):
+        if self.device_id:
+            return self.device_id
+        if self.looking_up:
+            return await self.looking_up
+
+        self.looking_up = future = tornado.concurrent.Future()
+        self.lookups += 1
+        try:
+            self.device_id = await self.lookup()
+            future.set_result(self.device_id)
+            return self.device_id
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()   # Retrieved, even if nobody else was waiting
+            raise
+        finally:
+            self.looking_up = None
+
+    # Device id known from elsewhere, e.g. the current playback
+    def update(self, device_id):
+        self.device_id = device_id
+
+    def invalidate(self):
+        self.device_id = None
+
+    # Await fn(device_id). If it fails, look the device up again and retry
+    # once if the id changed.
+    async def call(self, fn):
+        device_id = await self.get()
+        try:
+            return await fn(device_id)
+        except Exception:
+            self.invalidate()
+            if await self.get() == device_id:
+                raise
+        return await fn(self.device_id)
+
+    def stats(self):
+        return {"device_id": self.device_id, "lookups": self.lookups}
+
+
+class ControlDispatcher:
+    def __init__(self, debounce=0.25):
+        self.debounce = debounce   # Seconds a coalescing command waits for newer values
+        self.pending = {}          # player -> OrderedDict key -> [due, send, futures], in the order submitted
+        self.running = set()       # Players with a dispatch loop running
+        self.unique = itertools.count()
+        self.submitted = 0
+        self.sent = 0
+
+    # Send a command to player with send(), a coroutine function. Commands
+    # with coalesce=True replace a waiting command with the same key. Returns
+    # a future resolved with the result of the send that carried the command.
+    def submit(self, player, key, send, coalesce=True):
+        self.submitted += 1
+        commands = self.pending.setdefault(player, OrderedDict())
+        if not coalesce:
+            key = (key, next(self.unique))
+        future = tornado.concurrent.Future()
+        if key in commands:
+            commands[key][1] = send
+            commands[key][2].append(future)
+        else:
+            commands[key] = [time.monotonic() + (self.debounce if coalesce else 0), send, [future]]
+        if player not in self.running:
+            self.running.add(player)
+            tornado.ioloop.IOLoop.current().spawn_callback(self._dispatch, player)
+        return future
+
+    async def _dispatch(self, player):
+        commands = self.pending[player]
+        try:
+            while commands:
+                due = next(iter(commands.values()))[0]
+                if due > time.monotonic():
+                    await tornado.gen.sleep(due - time.monotonic())
+                key, (due, send, futures) = commands.popitem(last=False)   # With the latest value submitted
+                self.sent += 1
+                try:
+                    result = await send()
+                except Exception as e:
+                    for future in futures:
+                        future.set_exception(e)
+                        future.exception()   # Callers that don't wait for the result don't want a warning
+                    continue
+                for future in futures:
+                    future.set_result(result)
+        except Exception:
+            print(traceback.format_exc())
+        finally:
+            self.running.discard(player)
+
+    def stats(self):
+        return {"submitted": self.submitted, "sent": self.sent}
@@ -0,0 +1,122 @@
+# Schedules the switch from the playing track to the next one when they are
+# played by different players (MPD -> Spotify or Spotify -> MPD), where neither
+# player can queue the next track itself.
+#
+# The handoff is re-armed every time fresh progress of the playing track is
+# known, so pauses, seeks and drift are corrected for. A warm-up step (e.g.
+# resolving the Spotify device) runs shortly before the switch, and the gap
+# between the end of one track and the start of the next is measured and used
+# to start later handoffs a little earlier.
+
+import time
+import traceback
+from collections import deque
+
+import tornado.ioloop
+
+
+class HandoffScheduler:
+    def __init__(self, warmup_lead=5, tolerance=0.25, max_compensation=2):
+        self.warmup_lead = warmup_lead            # Seconds before the switch when prepare() is run
+        self.tolerance = tolerance                # Don't re-arm timers for smaller corrections than this
+        self.max_compensation = max_compensation  # Max seconds a handoff is started early
+        self.compensation = 0
+        self.gaps = deque(maxlen=20)              # Measured gaps in seconds, negative means overlap
+
+        self.track_id = None    # Track the armed handoff starts
+        self.end = None         # When the playing track ends, in time.monotonic() seconds
+        self.start = None
+        self.prepare = None
+        self.prepared = None
+        self.warm_timer = None
+        self.fire_timer = None
+        self.fired = None       # (track_id, end) of the last handoff, until its gap is measured
+
+    def _clear_timers(self):
+        io_loop = tornado.ioloop.IOLoop.current()
+        for timer in (self.warm_timer, self.fire_timer):
+            if timer:
+                io_loop.remove_timeout(timer)
+        self.warm_timer = None
+        self.fire_timer = None
+
+    # Arm (or re-arm) a handoff to track_id when the playing track ends in
+    # time_left seconds. start(prepared) starts the next track, prepare() is
+    # awaited shortly before and its result passed to start().
+    def arm(self, track_id, time_left, start, prepare=None):
+        end = time.monotonic() + time_left
+        if track_id == self.track_id and abs(end - self.end) < self.tolerance:
+            return
+
+        if track_id != self.track_id:
+            if self.track_id:
+                print("Handoff to", self.track_id, "replaced by handoff to", track_id)
+            self.prepared = None
+        self._clear_timers()
+        self.track_id = track_id
+        self.end = end
+        self.start = start
+        self.prepare = prepare
+
+        io_loop = tornado.ioloop.IOLoop.current()
+        if prepare and self.prepared is None:
+            self.warm_timer = io_loop.call_later(max(0, time_left - self.warmup_lead), self._warm)
+        self.fire_timer = io_loop.call_later(max(0, time_left - self.compensation), self.fire)
+
+    def cancel(self):
+        if self.track_id:
+            print("Handoff to", self.track_id, "cancelled")
+        self._reset()
+
+    def _reset(self):
+        self._clear_timers()
+        self.track_id = None
+        self.end = None
+        self.start = None
+        self.prepare = None
+        self.prepared = None
+
+    def armed(self):
+        return self.track_id
+
+    async def _warm(self):
+        self.warm_timer = None
+        try:
+            self.prepared = await self.prepare()
+        except Exception as e:
+            print("Handoff warm-up failed:", e)
+
+    # Start the armed handoff now. ended=True means the playing track has
+    # already stopped, possibly earlier than we expected.
+    async def fire(self, ended=False):
+        if not self.track_id:
+            return
+        track_id, end, start, prepared = self.track_id, self.end, self.start, self.prepared
+        self._reset()
+        self.fired = (track_id, min(end, time.monotonic()) if ended else end)
+
+        print("Handing off to", track_id)
+        try:
+            await start(prepared)
+        except Exception:
+            print(traceback.format_exc())
+            self.fired = None
+
+    # Called with the track that is playing and its progress in seconds, to
+    # measure the gap of the last handoff once the new track is playing
+    def started(self, track_id, progress):
+        if not self.fired or self.fired[0] != track_id:
+            return
+
+        gap = (time.monotonic() - progress) - self.fired[1]
+        self.fired = None
+        self.gaps.append(gap)
+        self.compensation = min(max(self.compensation + gap/2, 0), self.max_compensation)
+        print("Handoff to", track_id, "gap %.2f s, now starting handoffs %.2f s early" % (gap, self.compensation))
+
+    def stats(self):
+        return {
+            "armed": self.track_id,
+            "compensation": self.compensation,
+            "gaps": list(self.gaps),
+        }
@@ -0,0 +1,128 @@
+# Play history in MySQL: what was enqueued, started, deleted and charged, by
+# whom and for how much. Events are buffered in memory and written every
+# flush_interval seconds with one multi-row INSERT, on connections from a pool.
+#
+# Play counts per track are aggregated from the history every top_interval
+# seconds and kept in memory, for the most played list and for boosting
+# popular tracks in search results without asking MySQL per request.
+
+import datetime
+
+import tornado.ioloop
+
+import upstream
+
+
+class PlayHistory:
+    def __init__(self, pool, enabled=True, flush_interval=5, max_buffer=10000, top_interval=300, top_days=90, top_size=1000):
+        self.pool = pool                    # Returns a mysql.connector pool, called in upstream threads
+        self.enabled = enabled              # False if there is no MySQL, events are then dropped
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer        # Oldest events are dropped beyond this while MySQL is down
+        self.top_interval = top_interval
+        self.top_days = top_days            # Plays counted for the aggregate
+        self.top_size = top_size
+        self.buffer = []
+        self.flushing = False
+        self.created = False
+        self.dropped = 0
+        self.top = []          # Most played first: {"id", "type", "name", "artist", "plays"}
+        self.plays = {}        # track id -> plays, for the tracks in top
+
+    def record(self, event, entry, user=None, cost=None):
+        if not self.enabled:
+            return
+        if len(self.buffer) >= self.max_buffer:
+            self.buffer.pop(0)
+            self.dropped += 1
+        self.buffer.append((datetime.datetime.now(), event, entry.id, entry.type, entry.name[:255], entry.artist[:255],
+                            user if user is not None else entry.user, cost if cost is not None else entry.cost))
+
+    def start(self):
+        tornado.ioloop.PeriodicCallback(self.flush, self.flush_interval*1000).start()
+        tornado.ioloop.PeriodicCallback(self.aggregate, self.top_interval*1000).start()
+        tornado.ioloop.IOLoop.current().add_callback(self.aggregate)
+
+    def _connection(self):
+        connection = self.pool().get_connection()
+        if not self.created:
+            cursor = connection.cursor()
+            cursor.execute("""CREATE TABLE IF NOT EXISTS play_history (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                time DATETIME NOT NULL,
+                event VARCHAR(16) NOT NULL,
+                track_id VARCHAR(255) NOT NULL,
+                track_type VARCHAR(8) NOT NULL,
+                name VARCHAR(255),
+                artist VARCHAR(255),
+                user VARCHAR(16),
+                cost INT,
+                INDEX (event, time),
+                INDEX (track_id))""")
+            cursor.close()
+            self.created = True
+        return connection
+
+    def _insert(self, rows):
+        connection = self._connection()
+        try:
+            cursor = connection.cursor()
+            # executemany() turns this into one multi-row INSERT
+            cursor.executemany("INSERT INTO play_history (time, event, track_id, track_type, name, artist, user, cost) "
+                               "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)", rows)
+            connection.commit()
+            cursor.close()
+        finally:
+            connection.close()   # Back to the pool
+
+    def _select_top(self):
+        connection = self._connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT track_id, track_type, MAX(name), MAX(artist), COUNT(*) AS plays FROM play_history "
+                           "WHERE event='start' AND time > %s GROUP BY track_id, track_type ORDER BY plays DESC LIMIT %s",
+                           (datetime.datetime.now() - datetime.timedelta(days=self.top_days), self.top_size))
+            rows = cursor.fetchall()
+            cursor.close()
+            return rows
+        finally:
+            connection.close()
+
+    async def flush(self):
+        if self.flushing or not self.buffer:
+            return
+        self.flushing = True
+        rows, self.buffer = self.buffer, []
+        try:
+            await upstream.run("mysql", self._insert, rows)
+        except Exception as e:
+            print("Writing", len(rows), "play history events failed:", e)
+            self.buffer = rows + self.buffer
+            if len(self.buffer) > self.max_buffer:
+                self.dropped += len(self.buffer) - self.max_buffer
+                self.buffer = self.buffer[-self.max_buffer:]
+        finally:
+            self.flushing = False
+
+    async def aggregate(self):
+        if not self.enabled:
+            return
+        try:
+            rows = await upstream.run("mysql", self._select_top)
+        except Exception as e:
+            print("Reading most played tracks failed:", e)
+            return
+        self.top = [{"id": track_id, "type": track_type, "name": name, "artist": artist, "plays": plays}
+                    for track_id, track_type, name, artist, plays in rows]
+        self.plays = {track['id']: track['plays'] for track in self.top}
+
+    def most_played(self, limit=20):
+        return self.top[:limit]
+
+    # Search score bonus for popular tracks, 0 to 0.2
+    def boost(self, track_id):
+        plays = self.plays.get(track_id, 0)
+        return 0.2 * plays / (plays + 10)
+
+    def stats(self):
+        return {"buffered": len(self.buffer), "dropped": self.dropped, "top": len(self.top)}
@@ -0,0 +1,140 @@
+# Append-only journal of play queue changes, so that tracks users have paid for
+# survive a restart or crash. Operations are buffered in memory and written in
+# batches with one fsync per batch from a background thread, never on the
+# request path. Every compact_every operations the whole queue is written as a
+# snapshot and the journal is started over.
+#
+# Every operation has a sequence number and the snapshot stores the last one
+# it includes, so a crash between writing the snapshot and truncating the
+# journal does not apply operations twice.
+
+import json
+import os
+
+import tornado.ioloop
+
+import upstream
+from playqueue import PlayQueue, QueueEntry
+
+
+# Apply one journal operation to the queue. The PlayQueue methods are called
+# directly, so that subclasses which forward changes elsewhere (SharedQueue)
+# change themselves. Unknown operations are ignored.
+def apply_op(queue, op):
+    if op['op'] == "enqueue":
+        PlayQueue.append(queue, QueueEntry.from_record(op['entry']))
+    elif op['op'] == "delete":
+        PlayQueue.delete(queue, op['id'])
+    elif op['op'] == "trim":
+        PlayQueue.trim_until(queue, op['id'])
+    elif op['op'] == "handoff":
+        for entry in queue:
+            if entry.id == op['id']:
+                entry.in_queue = True
+                break
+    elif op['op'] == "clear":
+        PlayQueue.clear(queue)
+
+
+class QueueJournal:
+    def __init__(self, queue, path, flush_interval=0.5, compact_every=500):
+        self.queue = queue
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.flush_interval = flush_interval
+        self.compact_every = compact_every
+        self.seq = 0
+        self.since_snapshot = 0
+        self.buffer = []
+        self.flushing = False
+        self.timer = tornado.ioloop.PeriodicCallback(self.flush, flush_interval*1000)
+
+    def record(self, op, **data):
+        self.seq += 1
+        self.since_snapshot += 1
+        data.update(seq=self.seq, op=op)
+        self.buffer.append(json.dumps(data, separators=(",", ":")))
+
+    def apply(self, op):
+        apply_op(self.queue, op)
+
+    # Rebuild the queue from the snapshot and the journal, then start recording
+    # changes. Returns the number of queue entries recovered.
+    def load(self):
+        self.queue.journal = None
+        snapshot_seq = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+            snapshot_seq = snapshot['seq']
+            for record in snapshot['queue']:
+                self.queue.append(QueueEntry.from_record(record))
+        self.seq = snapshot_seq
+
+        replayed = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except ValueError:   # Half written last line from a crash
+                        break
+                    if op['seq'] <= snapshot_seq:
+                        continue
+                    self.apply(op)
+                    self.seq = op['seq']
+                    replayed += 1
+
+        print("Recovered", len(self.queue), "queued tracks from", self.snapshot_path, "and", replayed, "journal entries")
+        self.since_snapshot = replayed
+        self.queue.journal = self
+        return len(self.queue)
+
+    def start(self):
+        self.timer.start()
+
+    def _append(self, lines):
+        with open(self.path, 'a') as f:
+            f.write("\n".join(lines)+"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_snapshot(self, snapshot):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        with open(self.path, 'w') as f:
+            f.flush()
+            os.fsync(f.fileno())
+
+    # Write buffered operations to disk, or a snapshot if it is time to compact
+    async def flush(self):
+        compact = self.since_snapshot >= self.compact_every
+        if self.flushing or not (self.buffer or compact):
+            return
+        self.flushing = True
+        try:
+            if compact:
+                # The snapshot is taken now on the IOLoop, so it includes everything in the buffer
+                snapshot = {"seq": self.seq, "queue": [entry.to_record() for entry in self.queue]}
+                self.buffer = []
+                self.since_snapshot = 0
+                try:
+                    await upstream.run("journal", self._write_snapshot, snapshot)
+                except Exception:
+                    self.since_snapshot = self.compact_every   # Try again next time
+                    raise
+            else:
+                lines, self.buffer = self.buffer, []
+                try:
+                    await upstream.run("journal", self._append, lines)
+                except Exception:
+                    self.buffer = lines + self.buffer
+                    raise
+        except Exception as e:
+            print("Writing queue journal failed:", e)
+        finally:
+            self.flushing = False
@@ -0,0 +1,191 @@
+# In-process ledger of user credits. Balances from BILL are cached for a short
+# while, credits are reserved atomically when a track is enqueued, and the debit
+# is written to BILL in the background. A debit is retried until BILL has it
+# as long as it surely never reached BILL; one that may have been made is not
+# sent again but set aside for checking by hand (see unresolved).
+#
+# All methods are meant to be called on the IOLoop thread; the BILL calls
+# themselves run in the "bill" upstream pool.
+
+import time
+
+import tornado.ioloop
+
+import upstream
+from bill import BILLNotSent
+
+
+class Account:
+    def __init__(self):
+        self.balance = None  # Last balance read from BILL
+        self.fetched = 0     # When balance was read
+        self.held = 0        # Credits reserved or debited but not yet written to BILL
+        self.version = 0     # Bumped whenever a debit is written, see refresh()
+        self.debiting = 0    # Debits being written to BILL right now
+        self.last_seen = time.monotonic()
+
+
+class Reservation:
+    def __init__(self, bill_key, amount):
+        self.bill_key = bill_key
+        self.amount = amount
+        self.done = False
+        self.attempts = 0
+
+
+class CreditLedger:
+    def __init__(self, bill_client, ttl=15, retry_interval=5, max_attempts=20, idle_timeout=600):
+        self.bill_client = bill_client
+        self.ttl = ttl                        # Seconds a balance from BILL is trusted
+        self.retry_interval = retry_interval  # Seconds between attempts to write a failed debit
+        self.max_attempts = max_attempts
+        self.idle_timeout = idle_timeout      # Forget accounts not used for this many seconds
+        self.accounts = {}
+        self.debits = []                      # Committed reservations waiting to be written to BILL
+        self.unresolved = []                  # Debits that may or may not have reached BILL
+        self.flushing = False
+
+    def account(self, bill_key):
+        if bill_key not in self.accounts:
+            self.accounts[bill_key] = Account()
+        account = self.accounts[bill_key]
+        account.last_seen = time.monotonic()
+        return account
+
+    # Available credits if known, without asking BILL
+    def cached_balance(self, bill_key):
+        account = self.accounts.get(bill_key)
+        if account is None or account.balance is None:
+            return None
+        return account.balance - account.held
+
+    async def refresh(self, bill_key):
+        account = self.account(bill_key)
+        version = account.version if not account.debiting else None
+        balance = await upstream.run("bill", self.bill_client.get_credits, bill_key)
+        # A debit written while we were waiting may or may not be included in
+        # the answer, so only trust it if no debit was in flight meanwhile
+        if account.version == version:
+            account.balance = balance
+            account.fetched = time.monotonic()
+
+    # Available credits, read from BILL if the cached value is too old
+    async def balance(self, bill_key):
+        account = self.account(bill_key)
+        if account.balance is None or time.monotonic() - account.fetched > self.ttl:
+            await self.refresh(bill_key)
+        return account.balance - account.held
+
+    # Reserve credits for an enqueue. Returns a Reservation, or None if the user
+    # can not afford it. Must be followed by commit() or release().
+    async def reserve(self, bill_key, amount):
+        await self.balance(bill_key)
+
+        # No awaits between the check and the hold, so two fast clicks can not both pass
+        account = self.account(bill_key)
+        if account.balance - account.held - amount < 0:
+            return None
+        account.held += amount
+        return Reservation(bill_key, amount)
+
+    # Give back reserved credits, e.g. when playback failed
+    def release(self, reservation):
+        if reservation.done:
+            return
+        reservation.done = True
+        self.account(reservation.bill_key).held -= reservation.amount
+
+    # Charge reserved credits. The debit is written to BILL in the background.
+    def commit(self, reservation):
+        if reservation.done:
+            return
+        if reservation.amount == 0:
+            self.release(reservation)
+            return
+        reservation.done = True
+        self.debits.append(reservation)
+        tornado.ioloop.IOLoop.current().add_callback(self.flush)
+
+    # Write committed debits to BILL, in order
+    async def flush(self):
+        if self.flushing:
+            return
+        self.flushing = True
+        try:
+            while self.debits:
+                reservation = self.debits[0]
+                await self.debit_started(reservation)
+                try:
+                    await upstream.run("bill", self.bill_client.consume_credit, reservation.bill_key, reservation.amount)
+                    written = True
+                except (upstream.UpstreamUnavailable, BILLNotSent) as e:  # Never sent, try again later
+                    if not isinstance(e, upstream.UpstreamUnavailable):   # Not tried while the circuit breaker is open
+                        reservation.attempts += 1
+                    print("Writing debit of", reservation.amount, "credits for", reservation.bill_key, "to BILL failed:", e)
+                    if reservation.attempts < self.max_attempts:
+                        await self.debit_done(reservation, None)
+                        tornado.ioloop.IOLoop.current().call_later(self.retry_interval, self.flush)
+                        return
+                    print("Giving up on debit of", reservation.amount, "credits for", reservation.bill_key)
+                    written = False
+                except OSError as e:  # Timed out or lost the connection after sending, BILL may have made the debit
+                    print("Debit of", reservation.amount, "credits for", reservation.bill_key, "may or may not have been made, "
+                          "check it in BILL by hand:", e)
+                    self.unresolved.append(reservation)
+                    written = False   # The balance is read from BILL again, and shows whether it was made
+                except Exception as e:  # BILL refused the debit
+                    print("BILL refused debit of", reservation.amount, "credits for", reservation.bill_key+":", e)
+                    written = False
+
+                self.debits.pop(0)
+                await self.debit_done(reservation, written)
+        finally:
+            self.flushing = False
+
+    # Book an attempt to write a debit to BILL. A balance read that overlaps
+    # the attempt in any way is not trusted (see refresh()).
+    async def debit_started(self, reservation):
+        account = self.account(reservation.bill_key)
+        account.version += 1
+        account.debiting += 1
+
+    # Book the end of the attempt: written is None if it is retried later,
+    # True once BILL has the debit and False if it never will
+    async def debit_done(self, reservation, written):
+        account = self.account(reservation.bill_key)
+        account.version += 1
+        account.debiting -= 1
+        if written is None:
+            return
+        account.held -= reservation.amount
+        if written:
+            account.balance -= reservation.amount
+        else:
+            account.fetched = 0   # Read the real balance from BILL next time
+
+    def stats(self):
+        return {"accounts": len(self.accounts), "debits": len(self.debits),
+                "unresolved": [{"bill_key": reservation.bill_key, "amount": reservation.amount} for reservation in self.unresolved]}
+
+    # Periodically re-read balances of active users from BILL in one pipelined
+    # round trip, so that page renders are served from the cache, and forget
+    # users that have gone away.
+    async def reconcile(self):
+        now = time.monotonic()
+        for bill_key, account in list(self.accounts.items()):
+            if now - account.last_seen > self.idle_timeout and account.held == 0:
+                del self.accounts[bill_key]
+
+        stale = [(bill_key, account) for bill_key, account in self.accounts.items() if now - account.fetched > self.ttl/2]
+        if not stale:
+            return
+        versions = [account.version if not account.debiting else None for bill_key, account in stale]
+        try:
+            balances = await upstream.run("bill", self.bill_client.get_credits_many, [bill_key for bill_key, account in stale])
+        except Exception as e:   # Tried again next time, balances are read on demand meanwhile
+            print("Reconciling", len(stale), "credit balances failed:", e)
+            return
+        for (bill_key, account), version, balance in zip(stale, versions, balances):
+            if account.version == version:
+                account.balance = balance
+                account.fetched = time.monotonic()
@@ -0,0 +1,103 @@
+# In-memory search index of the MPD library. Songs are indexed on trigrams of
+# the words in their path, artist and title, which gives fast and typo tolerant
+# search without asking MPD. main.py keeps it fresh by re-reading the library
+# whenever MPD reports a "database" event.
+
+import re
+import threading
+from collections import Counter
+
+
+def tokenize(text):
+    return [token for token in re.split(r"[\W_]+", text.lower()) if token]
+
+# Trigrams of a word, padded so that word starts/ends and short words count too
+def trigrams(token):
+    padded = " "+token+" "
+    return {padded[i:i+3] for i in range(len(padded)-2)}
+
+
+class LibraryIndex:
+    def __init__(self, limit=50, min_score=0.5):
+        self.limit = limit          # Max number of results returned by search()
+        self.min_score = min_score  # Share of query trigrams a song must match
+        self.lock = threading.Lock()
+        self.songs = {}             # file -> song dict from listallinfo
+        self.texts = {}             # file -> lowercased text the song is searched on
+        self.postings = {}          # trigram -> set of files
+        self.ready = False
+
+    def _text(self, song):
+        filename = song['file'].rsplit(".", 1)[0]   # No file extension
+        return " ".join([filename, song.get('artist', ""), song.get('title', "")]).lower()
+
+    def _add(self, song):
+        text = self._text(song)
+        self.songs[song['file']] = song
+        self.texts[song['file']] = text
+        for token in tokenize(text):
+            for trigram in trigrams(token):
+                self.postings.setdefault(trigram, set()).add(song['file'])
+
+    def _remove(self, file):
+        for token in tokenize(self.texts.pop(file)):
+            for trigram in trigrams(token):
+                files = self.postings.get(trigram)
+                if files is not None:
+                    files.discard(file)
+                    if not files:
+                        del self.postings[trigram]
+        del self.songs[file]
+
+    # Bring the index up to date with the output of listallinfo. Only songs that
+    # were added, removed or modified since the last update are re-indexed.
+    def update(self, entries):
+        songs = {entry['file']: entry for entry in entries if 'file' in entry}
+        with self.lock:
+            removed = [file for file in self.songs if file not in songs]
+            changed = [song for file, song in songs.items()
+                       if file not in self.songs or self.songs[file].get('last-modified') != song.get('last-modified')]
+
+            for file in removed:
+                self._remove(file)
+            for song in changed:
+                if song['file'] in self.songs:
+                    self._remove(song['file'])
+                self._add(song)
+            self.ready = True
+
+        print("Library index updated:", len(changed), "added/changed,", len(removed), "removed,", len(songs), "songs total")
+
+    def get(self, file):
+        return self.songs.get(file)
+
+    # Songs matching query, best match first. boost(file), if given, is added
+    # to the score of every match, which is 0-2.
+    def search(self, query, limit=None, boost=None):
+        query_trigrams = set()
+        for token in tokenize(query):
+            query_trigrams |= trigrams(token)
+        if not query_trigrams:
+            return []
+
+        query = query.lower().strip()
+        with self.lock:
+            matches = Counter()
+            for trigram in query_trigrams:
+                matches.update(self.postings.get(trigram, ()))
+
+            needed = self.min_score * len(query_trigrams)
+            ranked = []
+            for file, count in matches.items():
+                if count < needed:
+                    continue
+                score = count / len(query_trigrams)
+                if query in self.texts[file]:   # Exact substring matches first
+                    score += 1
+                if boost:
+                    score += boost(file)
+                ranked.append((-score, file))
+
+            ranked.sort()
+            return [self.songs[file] for score, file in ranked[:limit or self.limit]]
+
@@ -0,0 +1,119 @@
+# Checks done before a login attempt is sent to BILL: the client must be in an
+# allowed country according to GeoIP, and one IP may only try so often. Both
+# checks are in memory with fixed bounds, so a flood of login attempts costs
+# neither file opens nor a growing dict.
+
+import os
+import time
+from collections import OrderedDict
+
+import geoip2.database
+import geoip2.errors
+
+from cache import TTLCache
+
+
+# GeoLite2 country database, opened once and memory-mapped. The file is
+# re-opened when its mtime changes (e.g. after geoipupdate), which is checked
+# at most every check_interval seconds.
+class GeoIPReader:
+    def __init__(self, path, check_interval=60):
+        self.path = path
+        self.check_interval = check_interval
+        self.reader = None
+        self.mtime = None
+        self.checked = 0
+        self.on_reload = None   # Called after a new database has been loaded
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return   # Keep using what we have, if anything
+
+        if mtime != self.mtime:
+            old, self.reader = self.reader, geoip2.database.Reader(self.path, mode=geoip2.database.MODE_MMAP)
+            self.mtime = mtime
+            if old:
+                old.close()
+            print("Loaded GeoIP database", self.path, self.reader.metadata().database_type)
+            if self.on_reload:
+                self.on_reload()
+
+    # ISO code of the country of ip, None if the address is not in the
+    # database. Raises if there is no database.
+    def country(self, ip):
+        if time.monotonic() - self.checked > self.check_interval:
+            self.checked = time.monotonic()
+            self.reload()
+        if not self.reader:
+            raise Exception("GeoIP database "+self.path+" not available")
+
+        try:
+            return self.reader.country(ip).country.iso_code
+        except geoip2.errors.AddressNotFoundError:
+            return None
+
+
+# Per IP token buckets: every IP may do burst attempts at once and then one
+# every 1/rate seconds. Buckets are kept least recently used first; the ones
+# that have refilled completely carry no information and are dropped, and at
+# most max_clients are kept in any case.
+class RateLimiter:
+    def __init__(self, rate=1/3, burst=1, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()  # ip -> (tokens, last update in time.monotonic())
+
+    def _evict(self, now):
+        full_after = self.burst / self.rate
+        while self.buckets:
+            ip, (tokens, updated) = next(iter(self.buckets.items()))
+            if len(self.buckets) <= self.max_clients and now - updated < full_after:
+                break
+            del self.buckets[ip]
+
+    # Take one token for ip, returns False if there was none left
+    def allow(self, ip):
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(ip, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[ip] = (tokens, now)
+        self._evict(now)
+        return allowed
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class LoginGuard:
+    def __init__(self, geoip_path, allowed_countries=("FI",), verdict_cache_size=10000, verdict_ttl=3600,
+                 rate=1/3, burst=1, max_clients=10000):
+        self.geoip = GeoIPReader(geoip_path)
+        self.allowed_countries = frozenset(allowed_countries)
+        self.verdicts = TTLCache(max_size=verdict_cache_size, ttl=verdict_ttl)  # ip -> country
+        self.geoip.on_reload = self.verdicts.clear
+        self.limiter = RateLimiter(rate, burst, max_clients)
+
+    # (allowed, country) for a login from ip. Addresses GeoIP does not know
+    # (e.g. the local network) and GeoIP failures are let through.
+    def check_country(self, ip):
+        country = self.verdicts.get(ip, False)
+        if country is False:
+            try:
+                country = self.geoip.country(ip)
+            except Exception as e:
+                print("GeoIP lookup of", ip, "failed:", e)
+                return True, None
+            self.verdicts.put(ip, country)
+        return country is None or country in self.allowed_countries, country
+
+    def throttle(self, ip):
+        return not self.limiter.allow(ip)
+
+    def stats(self):
+        return {"verdicts": self.verdicts.stats(), "tracked_ips": len(self.limiter)}
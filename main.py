@@ -1,22 +1,53 @@
 #!/usr/bin/python3
 
+import asyncio
+import json
+import math
 import traceback
+import time
 import socket
 import mysql.connector
-from datetime import datetime, timedelta
+import mysql.connector.pooling
+import threading
+from datetime import timedelta
 from dotenv import load_dotenv
 import os
 import subprocess
 import html
-import geoip2.database
 
 import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
+from spotipy.oauth2 import SpotifyClientCredentials
 
-from mpd import MPDClient
+from mpdpool import MPDPool, MPDWatcher, read_commands
+from mpd import ConnectionError as MPDConnectionError
 
+import tornado.gen
+import tornado.httpserver
 import tornado.ioloop
+import tornado.locks
+import tornado.netutil
+import tornado.process
+import tornado.util
 import tornado.web
+from tornado.iostream import StreamClosedError
+
+import metrics
+import upstream
+from bill import BILLClient
+from ledger import CreditLedger
+from sessions import AdminKeys, UserCache
+from cache import TTLCache
+from library import LibraryIndex
+from handoff import HandoffScheduler
+from push import StateBroadcaster, EventsHandler
+from playqueue import PlayQueue, QueueEntry
+from journal import QueueJournal, apply_op
+from shared import SharedStore, SharedQueue, SharedCreditLedger
+from history import PlayHistory
+from control import DeviceCache, ControlDispatcher
+from spotifybudget import SpotifyBudget, SpotifyBusy, PLAYBACK, CONTROL, STATE, SEARCH
+from spotifyauth import RefreshingOAuth
+from loginguard import LoginGuard
 
 
 load_dotenv()
@@ -26,35 +57,159 @@ debug = False
 
 # Define global variables
 spmask = None
-queue = []
-lastlogin = {}
+spotify_auth = None   # RefreshingOAuth of spmask
+queue = PlayQueue()
+queue_journal = QueueJournal(queue, os.getenv("QUEUE_JOURNAL", "queue.journal"))
+workers = int(os.getenv("WORKERS", 1))   # Worker processes, see shared.py
 
 
 def spotify_login():
     #raise Exception("Spotify API disabled")
 
-    global spmask
+    global spmask, spotify_auth
     if not spmask:
         print("Run spotify auth")
-        spmask = spotipy.Spotify(auth_manager=SpotifyOAuth(client_id=os.getenv("SPOTIFY_CLIENT_ID"),
-                                                           client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
-                                                           redirect_uri="http://example.com",  # You do not have to change the example.com URL
-                                                           scope="streaming,user-read-currently-playing,user-read-playback-state,user-read-playback-state",
-                                                           open_browser=False))
+        spotify_auth = RefreshingOAuth(client_id=os.getenv("SPOTIFY_CLIENT_ID"),
+                                       client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
+                                       redirect_uri="http://example.com",  # You do not have to change the example.com URL
+                                       scope="streaming,user-read-currently-playing,user-read-playback-state,user-read-playback-state",
+                                       open_browser=False)
+        spmask = spotipy.Spotify(auth_manager=spotify_auth,
+                                 status_forcelist=(500, 502, 503, 504))   # 429 is handled by spotify_budget, see spotifybudget.py
     return spmask
 
+spotify_token_margin = 600   # Refresh the Spotify access token this many seconds before it expires
 
-def mpd_connect():
-    mpdclient = MPDClient()
-    mpdclient.connect(os.getenv("MPD_SERVER"), 6600)
-    mpdclient.consume(1)   # Songs are removed from playlist after they played
-    return mpdclient
+# Keep the Spotify access token fresh, so that no API call has to wait for a refresh
+async def refresh_spotify_token():
+    if spotify_auth:
+        try:
+            await upstream.run("spotify", spotify_auth.refresh_if_expiring, spotify_token_margin)
+        except Exception as e:
+            print("Refreshing Spotify access token failed:", e)
+
+spotify_budget = SpotifyBudget(lambda method, *args, **kwargs: upstream.run("spotify", getattr(spotify_login(), method), *args, **kwargs),
+                               budget=int(os.getenv("SPOTIFY_BUDGET", 0)) or math.inf,
+                               max_in_flight=int(os.getenv("UPSTREAM_LIMIT_SPOTIFY", upstream.default_limits["spotify"])))
+
+# Spotify API call through spotify_budget, e.g. await spotify_call(SEARCH, "search", q=query)
+def spotify_call(priority, method, *args, **kwargs):
+    return spotify_budget.call(priority, method, *args, **kwargs)
+
+
+track_cache = TTLCache(max_size=5000, ttl=24*3600)  # Spotify track objects by track id
+search_cache = TTLCache(max_size=500, ttl=600)      # Spotify search responses by normalized query
+
+# Spotify track object, from the cache if we have seen the track recently
+async def spotify_track(track_id):
+    track = track_cache.get(track_id)
+    if track is None:
+        track = await spotify_call(CONTROL, "track", "spotify:track:"+track_id)
+        track_cache.put(track_id, track)
+    return track
+
+# Spotify track objects for track_ids, in the same order and without the ones
+# Spotify does not know. Tracks not in the cache are fetched 50 per call.
+async def spotify_tracks(track_ids):
+    missing = [track_id for track_id in dict.fromkeys(track_ids) if track_cache.get(track_id) is None]
+    for i in range(0, len(missing), 50):
+        results = await spotify_call(SEARCH, "tracks", missing[i:i+50])
+        for track_id, track in zip(missing[i:i+50], results['tracks']):
+            if track:
+                track_cache.put(track_id, track)
+    tracks = [track_cache.get(track_id) for track_id in track_ids]
+    return [track for track in tracks if track]
+
+# Spotify track objects of an album, at most limit
+async def spotify_album_tracks(album_id, limit):
+    track_ids = []
+    while len(track_ids) < limit:
+        page = await spotify_call(SEARCH, "album_tracks", album_id, limit=50, offset=len(track_ids))
+        track_ids += [track['id'] for track in page['items']]
+        if not page['next']:
+            break
+    return await spotify_tracks(track_ids[:limit])
+
+# Spotify track objects of a playlist, at most limit. Local files and podcast
+# episodes are skipped.
+async def spotify_playlist_tracks(playlist_id, limit):
+    tracks = []
+    offset = 0
+    while len(tracks) < limit:
+        page = await spotify_call(SEARCH, "playlist_items", playlist_id, limit=100, offset=offset, additional_types=["track"])
+        for item in page['items']:
+            track = item.get('track')
+            if track and track.get('id') and not track.get('is_local') and track.get('type', "track") == "track":
+                track_cache.put(track['id'], track)
+                tracks.append(track)
+        offset += len(page['items'])
+        if not page['next']:
+            break
+    return tracks[:limit]
+
+# Spotify search, cached per normalized query. Tracks in the results are cached
+# too, so that clicking on a search result needs no further lookup.
+async def spotify_search(query, offset=0, limit=10):
+    key = (" ".join(query.lower().split()), offset, limit)
+    results = search_cache.get(key)
+    if results is None:
+        results = await spotify_call(SEARCH, "search", q=query, limit=limit, offset=offset)
+        search_cache.put(key, results)
+        for track in results['tracks']['items']:
+            track_cache.put(track['id'], track)
+    return results
+
+
+# Count these as outages for the circuit breakers too, besides network errors
+upstream.outage_checks["mpd"] = lambda e: isinstance(e, MPDConnectionError)
+# spotipy retries 5xx answers (status_forcelist) and then raises a 429 "Max
+# Retries" without Retry-After, unlike a real 429
+upstream.outage_checks["spotify"] = lambda e: isinstance(e, spotipy.SpotifyException) and (
+    e.http_status >= 500 or (e.http_status == 429 and not (e.headers or {}).get("Retry-After")))
+
+mpd_pool = MPDPool(os.getenv("MPD_SERVER"), 6600, max_connections=int(os.getenv("MPD_POOL_SIZE", 4)))
+
+# Run an MPD command on a pooled connection, e.g. await mpd_command("add", song_url)
+async def mpd_command(command, *args):
+    return await upstream.run_as("mpd", command, mpd_pool.run, lambda mpdclient: getattr(mpdclient, command)(*args),
+                                 command in read_commands)
+
+# Ping idle pooled MPD connections so that MPD does not drop them
+async def mpd_keepalive():
+    try:
+        await upstream.run("mpd", mpd_pool.keepalive)
+    except Exception as e:
+        print("MPD keepalive failed:", e)
+
+
+library_index = LibraryIndex(limit=int(os.getenv("MPD_SEARCH_LIMIT", 50)))
+library_refreshing = False
+library_refresh_pending = False
+
+# Re-read the MPD library into library_index. Called by LibraryWatcher when MPD
+# reports database changes; changes arriving during a refresh cause one more run.
+async def refresh_library():
+    global library_refreshing, library_refresh_pending
+    library_refresh_pending = True
+    if library_refreshing:
+        return
+
+    library_refreshing = True
+    try:
+        while library_refresh_pending:
+            library_refresh_pending = False
+            songs = await mpd_command("listallinfo")
+            await upstream.run("library", library_index.update, songs)
+    except Exception as e:
+        print("Refreshing MPD library index failed:", e)
+    finally:
+        library_refreshing = False
 
 # Return Spotify device id of the device where playback should happen
-def get_playback_device_id():
+async def get_playback_device_id():
     active_device_name = None
     playback_device_id = None
-    for device in spotify_login().devices()['devices']:
+    for device in (await spotify_call(PLAYBACK, "devices"))['devices']:
         if(device['is_active']==True and device['name']!=playback_device_name):
             raise Exception("Uppspelning misslyckades: Spotify-konto i användning på: "+device['name'])
 
@@ -66,18 +221,28 @@ def get_playback_device_id():
 
     return playback_device_id
 
+# Playback device id, looked up again only when a call made with it fails
+spotify_device = DeviceCache(get_playback_device_id)
+control_dispatcher = ControlDispatcher()
+
+# Send e.g. spotify_login().volume(50, device_id=...) to the playback device through control_dispatcher
+def spotify_control(key, method, *args, coalesce=True):
+    return control_dispatcher.submit("spotify", key, lambda: spotify_device.call(
+        lambda device_id: spotify_call(CONTROL, method, *args, device_id=device_id)), coalesce)
+
 # Return "mpd", "spotify" or "none" where playback is RUNNING
-def get_playback_state():
-    mpdclient = mpd_connect()
-    mpdstatus = mpdclient.status()
+async def get_playback_state():
+    mpdstatus = await mpd_command("status")
 
     if mpdstatus['state'] == "play":
         return "mpd"
     else:
-        current_playback = spotify_login().current_playback()
+        current_playback = await spotify_call(CONTROL, "current_playback")
         if current_playback is not None:
             if(current_playback['device']['name']==playback_device_name and current_playback['is_playing']):
                 return "spotify"
+            if current_playback['device']['name']!=playback_device_name:
+                spotify_device.invalidate()   # In use elsewhere, see spotify_start_playback_with()
 
     return "none"
 
@@ -89,15 +254,45 @@ def mysql_get_cursor():
         mysql_connection.ping()
     except:
         print("Opening MySQL connection")
-        mysql_connection = mysql.connector.connect(host=os.getenv("MYSQL_HOST"), user=os.getenv("MYSQL_USER"),
-                                                   password=os.getenv("MYSQL_PASSWORD"), database=os.getenv("MYSQL_DATABASE"))
+        with metrics.timed("mysql", "connect"):
+            mysql_connection = mysql.connector.connect(host=os.getenv("MYSQL_HOST"), user=os.getenv("MYSQL_USER"),
+                                                       password=os.getenv("MYSQL_PASSWORD"), database=os.getenv("MYSQL_DATABASE"),
+                                                       autocommit=True)
+        metrics.connected("mysql")
 
     return mysql_connection.cursor()
 
-
-def get_song_cost(track_len, bill_user):
-    global queue
-    if(len(queue) == 0):
+# Pool of MySQL connections, created on first use from an upstream thread
+mysql_pool_instance = None
+mysql_pool_lock = threading.Lock()
+def mysql_pool():
+    global mysql_pool_instance
+    with mysql_pool_lock:
+        if mysql_pool_instance is None:
+            print("Opening MySQL connection pool")
+            with metrics.timed("mysql", "connect"):
+                mysql_pool_instance = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name="kakeplay", pool_size=int(os.getenv("UPSTREAM_LIMIT_MYSQL", upstream.default_limits["mysql"])),
+                    host=os.getenv("MYSQL_HOST"), user=os.getenv("MYSQL_USER"),
+                    password=os.getenv("MYSQL_PASSWORD"), database=os.getenv("MYSQL_DATABASE"))
+            metrics.connected("mysql")
+        return mysql_pool_instance
+
+play_history = PlayHistory(mysql_pool, enabled=bool(os.getenv("MYSQL_HOST")))
+
+# Tracks in the order Spotify ranked them, with often played tracks moved up a bit
+def boost_popular(tracks):
+    if not play_history.plays:
+        return tracks
+    ranked = sorted(enumerate(tracks), key=lambda item: item[0]/len(tracks) - play_history.boost(item[1]['id']))
+    return [track for position, track in ranked]
+
+
+# Credits for a track, queued = tracks ahead of it in the queue (default: the whole queue)
+def get_song_cost(track_len, bill_user, queued=None):
+    if queued is None:
+        queued = len(queue)
+    if(queued == 0):
         return 0
     elif (bill_user.is_admin):
         return 0
@@ -106,23 +301,21 @@ def get_song_cost(track_len, bill_user):
     else:
         return 1
 
-def bill_query(query):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((os.getenv("BILLSERVER_HOST"), 4242))
-        s.sendall( (query+"\n").encode("latin_1") )
-        response = s.recv(1024)
+bill_client = BILLClient(os.getenv("BILLSERVER_HOST"), 4242, max_connections=int(os.getenv("BILL_POOL_SIZE", 4)),
+                         timeout=float(os.getenv("BILL_TIMEOUT", 5)))
 
-        if(response != b".\n"):
-            return response.decode("latin_1").partition("\n")[0] # Read response from BILL-API until "\n"
-        else:
-            return None
+credit_ledger = CreditLedger(bill_client, ttl=float(os.getenv("CREDIT_CACHE_TTL", 15)))
+
+# Returns the response line from BILL-API, or None if BILL answered "."
+def bill_query(query):
+    return bill_client.query(query)
 
 class BILLUser:
     def __init__(self,billcode,check_code=True):
 
         if (check_code==False):
             if not(billcode and billcode.isdigit() and len(billcode)>=2 and len(billcode)<=4):
-                print("Invalid bill_key:", str(self.bill_key))
+                print("Invalid bill_key:", str(billcode))
                 raise Exception("bill_key read from secure cookie is not valid!")
             self.bill_key = billcode
 
@@ -140,81 +333,98 @@ class BILLUser:
             else:
                 raise Exception("Kontrollera BILL-kod")
 
-        # Check if user is admin
-        self.is_admin = False
-        if(os.path.exists('adminkeys')):
-            with open('adminkeys', 'r') as f:
-                for line in f:
-                    if line[:-1]==self.bill_key:
-                        self.is_admin = True
-                        break
+    # Check if user is admin
+    @property
+    def is_admin(self):
+        return self.bill_key in admin_keys
 
+admin_keys = AdminKeys('adminkeys')
+login_guard = LoginGuard(os.getenv("GEOIP_DATABASE", '/var/lib/GeoIP/GeoLite2-Country.mmdb'))
+bill_users = UserCache(lambda bill_key: BILLUser(bill_key,check_code=False))
 
-    def get_credits(self):
-        response = bill_query('602,3,'+self.bill_key+',0,0')
-        if response:
-            return int(response)
-        else:
-            return 0
 
-    def check_credit(self, change):
-        credits = self.get_credits()
-        return (credits-change >= 0)
+# Whether remote_ip has to wait before its next login attempt. With several
+# workers the limit is kept in the shared store, so it holds across them.
+async def login_throttled(remote_ip):
+    if shared_store:
+        limiter = login_guard.limiter
+        try:
+            return not await upstream.run("store", shared_store.allow_login, remote_ip, limiter.rate, limiter.burst)
+        except Exception as e:
+            print("Shared login limit not available:", e)
+    return login_guard.throttle(remote_ip)
+
+async def expire_logins():
+    try:
+        await upstream.run("store", shared_store.expire_logins)
+    except Exception as e:
+        print("Expiring shared login limits failed:", e)
+
 
-    def consume_credit(self, change):
-        if change == 0:
+# Errors of an upstream that is down, slow or rate limited. Handlers that let
+# them through answer 503 with the message instead of 500 and a traceback. A
+# failed socket counts, as in upstream.is_outage(), so a hang-up the breaker has
+# not yet opened on is not a 500 either.
+upstream_errors = (upstream.UpstreamTimeout, upstream.UpstreamUnavailable, OSError, MPDConnectionError, SpotifyBusy)
+
+class UpstreamErrorHandler(tornado.web.RequestHandler):
+    def log_exception(self, typ, value, tb):
+        if isinstance(value, upstream_errors):
+            print(self.request.method, self.request.uri, "failed:", value)
+            return
+        super().log_exception(typ, value, tb)
+
+    def write_error(self, status_code, **kwargs):
+        exc_info = kwargs.get("exc_info")
+        if exc_info and isinstance(exc_info[1], upstream_errors):
+            self.set_status(503)
+            self.set_header("Retry-After", "5")
+            self.finish(str(exc_info[1]))
             return
-        response = bill_query('702,3,'+self.bill_key+',0,0,'+str(-change))
-        if not response:
-            raise Exception("Debitering av kredit misslyckades")
+        super().write_error(status_code, **kwargs)
 
 
-class BaseHandler(tornado.web.RequestHandler):
+class BaseHandler(UpstreamErrorHandler):
     def get_current_user(self):
         return self.get_secure_cookie("user")
 
+    # BILLUser of the logged in user, from the session cache
+    def get_bill_user(self):
+        return bill_users.get(self.current_user.decode())
+
 class MainHandler(BaseHandler):
-    def get(self):
+    async def get(self):
         if not self.current_user:
             self.render("login.html")
             return
 
         global playback_device_name
         bill_key = self.current_user.decode()
-        bill_user = BILLUser(self.current_user.decode(),check_code=False)
+        bill_user = self.get_bill_user()
         name = self.get_secure_cookie("name").decode()
-        self.render("index.html", playback_device_name=playback_device_name, user=bill_key, name=name, admin=bill_user.is_admin, credits=BILLUser(bill_key,check_code=False).get_credits())
-
-    def post(self):
-        try:
-            with geoip2.database.Reader('/var/lib/GeoIP/GeoLite2-Country.mmdb') as reader:
-                remote_ip = self.request.headers.get("X-Forwarded-For") or self.request.remote_ip
-                response = reader.country(remote_ip)
-                client_country = response.country.iso_code
-                if (client_country != "FI"):
-                    print("GeoIP rejected login from IP", remote_ip, "("+client_country+")")
-                    self.write("Din IP-adress är inte godkänd för att använda denna tjänst.")
-                    return
-                print("User logged in from IP", remote_ip, "("+client_country+")")
-        except Exception as e:
-            print(traceback.format_exc())
+        credits = await credit_ledger.balance(bill_key)
+        self.render("index.html", playback_device_name=playback_device_name, user=bill_key, name=name, admin=bill_user.is_admin, credits=credits)
+
+    async def post(self):
+        remote_ip = self.request.headers.get("X-Forwarded-For") or self.request.remote_ip
+        allowed, client_country = login_guard.check_country(remote_ip)
+        if not allowed:
+            print("GeoIP rejected login from IP", remote_ip, "("+client_country+")")
+            self.write("Din IP-adress är inte godkänd för att använda denna tjänst.")
+            return
 
-        try:
-            remote_ip = self.request.headers.get("X-Forwarded-For") or self.request.remote_ip
-            if lastlogin[remote_ip] + timedelta(seconds=3) > datetime.now():
-                #self.set_status(429)  # 429 Too Many Requests
-                self.write("Kontrollera BILL-kod")
-                return
-        except:
-            pass
-        finally:
-            lastlogin[remote_ip] = datetime.now()
+        if await login_throttled(remote_ip):
+            #self.set_status(429)  # 429 Too Many Requests
+            self.write("Kontrollera BILL-kod")
+            return
+        print("User logged in from IP", remote_ip, "("+str(client_country)+")")
 
         try:
-            billuser = BILLUser(self.get_argument("billcode"))
+            billuser = await upstream.run("bill", BILLUser, self.get_argument("billcode"))
         except Exception as e:
             self.write(str(e))
             return
+        bill_users.put(billuser.bill_key, billuser)
 
         self.set_secure_cookie("user", billuser.bill_key)
         self.set_secure_cookie("name", billuser.name)
@@ -233,373 +443,940 @@ class SettingsHandler(BaseHandler):
 
 
 
+# Play history of a track a user paid for (or got for free)
+def record_enqueue(entry):
+    play_history.record("enqueue", entry)
+    if entry.cost:
+        play_history.record("charge", entry)
+
 class PlayHandler(BaseHandler):
     @tornado.web.authenticated
-    def get(self, song_url):
-        global queue
-        playback_state = get_playback_state()
-
-        bill_user = BILLUser(self.current_user.decode(),check_code=False)
-        song_length = float(spotify_login().track("spotify:track:"+song_url)['duration_ms'])/1000
-        if not bill_user.check_credit(get_song_cost(song_length,bill_user)):
+    async def get(self, song_url):
+        playback_state = await get_playback_state()
+
+        bill_user = self.get_bill_user()
+        track = await spotify_track(song_url)
+        song_length = float(track['duration_ms'])/1000
+        cost = get_song_cost(song_length,bill_user)
+        reservation = await credit_ledger.reserve(bill_user.bill_key, cost)
+        if not reservation:
             self.write("Kreditteckning saknas")
             return
 
+        entry = QueueEntry.from_spotify(track, bill_user.bill_key, cost)
         try:
             if playback_state=="none":  # Start playback immediately
-                spotify_start_playback_with(song_url)
+                await spotify_start_playback_with(song_url)
                 #queue=[(spotify_login().track("spotify:track:"+song_url))]
                 #queue[-1]['in_queue'] = True
 
             else: # Already playing, add the track to queue
                 #spotify_login().add_to_queue("spotify:track:"+song_url, device_id=get_playback_device_id())
-                queue.append(spotify_login().track("spotify:track:"+song_url))
-                queue[-1]['in_queue'] = False
+                queue.append(entry)
+                await queue.saved()
 
-            bill_user.consume_credit(get_song_cost(song_length,bill_user))
+            credit_ledger.commit(reservation)
+            record_enqueue(entry)
+            playback_engine.wake()
 
         # Pass exception to user as it may contain relevant info such as "Spotify account in use elsewhere"
         except Exception as e:
             print(e)
+            credit_ledger.release(reservation)
             self.write(str(e))
 
 class MPDPlayHandler(BaseHandler):
     @tornado.web.authenticated
-    def get(self):
-        global queue
+    async def get(self):
         song_url = self.get_argument('url', True)
         print(song_url)
 
-        mpdclient = mpd_connect()
-        song_info = mpdclient.listallinfo(song_url)[0]
-        song_info['id'] = song_info['file']
-        song_info['name'] = song_info['file'].split("/")[-1] # Remove directory part to get only filename
-        song_info['album'] = {'images': [
-                               {'url': "static/mp3_icon_600.png"},
-                               {'url': "static/mp3_icon_600.png"},
-                               {'url': "static/mp3_icon_64.png"}
-                             ]}
-        song_info['artists'] = [{'name': ""}]
-        song_info['type'] = "mpd"
-        song_info['in_queue'] = False
-
-        bill_user = BILLUser(self.current_user.decode(),check_code=False)
-        if not bill_user.check_credit(get_song_cost(float(song_info['duration']),bill_user)):
+        song_info = library_index.get(song_url)
+        if song_info is None:
+            song_info = (await mpd_command("listallinfo", song_url))[0]
+
+        bill_user = self.get_bill_user()
+        cost = get_song_cost(float(song_info.get('duration', 0)),bill_user)
+        reservation = await credit_ledger.reserve(bill_user.bill_key, cost)
+        if not reservation:
             self.write("Kreditteckning saknas")
             return
 
+        entry = QueueEntry.from_mpd(song_info, bill_user.bill_key, cost)
         try:
-            playback_state = get_playback_state()
+            playback_state = await get_playback_state()
             if playback_state=="spotify": # Already playing, what the f*** should I do now???
                 #mpdclient.add(song_url)
-                queue.append(song_info)
+                queue.append(entry)
+                await queue.saved()
             elif playback_state=="mpd":
                 #mpdclient.add(song_url)
-                queue.append(song_info)
+                queue.append(entry)
+                await queue.saved()
             else:                    # Start playback immediately
-                mpdclient.add(song_url)
-                mpdclient.play()
+                await mpd_command("add", song_url)
+                await mpd_command("play")
                 #queue=[song_info]   # Remember to change in_queue=True if uncomment this!
 
-            bill_user.consume_credit(get_song_cost(float(song_info['duration']),bill_user))
+            credit_ledger.commit(reservation)
+            record_enqueue(entry)
+            playback_engine.wake()
 
         # Pass exception to user as it may contain relevant info such as "Spotify account in use elsewhere"
         except Exception as e:
             print(e)
+            credit_ledger.release(reservation)
             self.write(str(e))
 
 
+bulk_enqueue_limit = int(os.getenv("BULK_ENQUEUE_LIMIT", 100))
+
+# Enqueue many tracks at once, POST one of
+#   ids=<Spotify track ids, comma separated>
+#   album=<Spotify album id>
+#   playlist=<Spotify playlist id>
+#   dir=<MPD directory>
+# Each track costs what it would if enqueued one at a time, and the whole
+# batch is charged in one BILL transaction.
+class BulkPlayHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def post(self):
+        bill_user = self.get_bill_user()
+        try:
+            entries = await self.resolve(bill_user.bill_key)
+        except tornado.web.MissingArgumentError:
+            raise
+        except Exception as e:
+            print(e)
+            self.write(str(e))
+            return
+        if not entries:
+            self.write("Inga låtar hittades")
+            return
+
+        playback_state = await get_playback_state()
+        start_now = playback_state=="none"   # The first track starts right away and is never queued
+        for i, entry in enumerate(entries):
+            entry.cost = get_song_cost(entry.duration, bill_user, max(i-1, 0) if start_now else len(queue)+i)
+        reservation = await credit_ledger.reserve(bill_user.bill_key, sum(entry.cost for entry in entries))
+        if not reservation:
+            self.write("Kreditteckning saknas")
+            return
+
+        try:
+            if start_now:
+                if entries[0].type=="mpd":
+                    await mpd_start_playback_with(entries[0].id)
+                else:
+                    await spotify_start_playback_with(entries[0].id)
+            for entry in (entries[1:] if start_now else entries):
+                queue.append(entry)
+            await queue.saved()
+
+            credit_ledger.commit(reservation)
+            for entry in entries:
+                record_enqueue(entry)
+            playback_engine.wake()
+
+        # Pass exception to user as it may contain relevant info such as "Spotify account in use elsewhere"
+        except Exception as e:
+            print(e)
+            credit_ledger.release(reservation)
+            self.write(str(e))
+            return
+
+        self.write({"added": len(entries), "cost": reservation.amount, "saldo": credit_ledger.cached_balance(bill_user.bill_key)})
+
+    # Queue entries for the request arguments, at most bulk_enqueue_limit
+    async def resolve(self, bill_key):
+        if self.get_argument('ids', None):
+            track_ids = [track_id.strip() for track_id in self.get_argument('ids').split(",") if track_id.strip()]
+            tracks = await spotify_tracks(track_ids[:bulk_enqueue_limit])
+        elif self.get_argument('album', None):
+            tracks = await spotify_album_tracks(self.get_argument('album'), bulk_enqueue_limit)
+        elif self.get_argument('playlist', None):
+            tracks = await spotify_playlist_tracks(self.get_argument('playlist'), bulk_enqueue_limit)
+        else:
+            songs = await mpd_command("listallinfo", self.get_argument('dir'))   # Files and directories below dir, in one call
+            songs = [song for song in songs if 'file' in song]
+            return [QueueEntry.from_mpd(song, bill_key) for song in songs[:bulk_enqueue_limit]]
+        return [QueueEntry.from_spotify(track, bill_key) for track in tracks]
+
+
 class DeleteHandler(BaseHandler):
     @tornado.web.authenticated
-    def post(self):
-        global queue
+    async def post(self):
         song_id = self.get_argument('id')
         print("Attempting to delete", song_id, "from playlist.")
 
-        for i in range(len(queue)):
-            if(queue[i]['id'] == song_id):
-                queue.pop(i)
-                break
+        entry = queue.delete(song_id)
+        if entry:
+            await queue.saved()
+            play_history.record("delete", entry, user=self.current_user.decode())
+            playback_engine.wake()   # Re-plan handoffs if the queue head changed
+
+# Search result as the browser expects it, for a Spotify track or an MPD song
+def spotify_search_result(track, bill_user):
+    return {
+        "name": track['name'],
+        "artist": track['artists'][0]['name'],
+        "image": track['album']['images'], "id": track['id'],
+        "credits": get_song_cost(int(track['duration_ms'])/1000, bill_user)
+    }
+
+def mpd_search_result(track, bill_user):
+    return {
+        "name": track['file'].split("/")[-1],  # Remove directory part to get only filename
+        "artist": track.get('artist', ""),
+        "image": [{"url": "static/mp3_icon_600.png"}, {"url": "static/mp3_icon_600.png"}, {"url": "static/mp3_icon_64.png"}],
+        "id": track['file'],
+        "credits": get_song_cost(float(track.get('duration', 0)), bill_user)
+    }
+
+# MPD songs matching query, results offset to offset+limit
+async def mpd_search(query, offset=0, limit=None):
+    limit = limit or library_index.limit
+    if library_index.ready:
+        songs = await upstream.run("library", library_index.search, query, offset+limit, play_history.boost)
+    else:   # Index not built yet, ask MPD
+        songs = await mpd_command("search", "filename", query)
+    return songs[offset:offset+limit]
 
 class SearchHandler(BaseHandler):
     @tornado.web.authenticated
-    def post(self):
-        bill_user = BILLUser(self.current_user.decode(),check_code=False)
+    async def post(self):
+        bill_user = self.get_bill_user()
 
         if(self.request.body==b''):
             return
         try:
-            results = spotify_login().search(q=self.request.body, limit=10)
+            results = await spotify_search(self.request.body.decode())
+        except upstream_errors as e:
+            self.set_status(503)   # Spotify rate limited or down, the search can be tried again
+            self.set_header("Retry-After", "5")
+            self.write(str(e))
+            return
         except Exception as e:
             self.set_status(500);
             self.write(str(e))
             return
-        results_list = []
-        for idx, track in enumerate(results['tracks']['items']):
-            results_list.append( {
-                "name": track['name'],
-                "artist": track['artists'][0]['name'],
-                "image": track['album']['images'], "id": track['id'],
-                "credits": get_song_cost(int(track['duration_ms'])/1000, bill_user)
-            })
-        self.write({"results": results_list})
+        results_list = [spotify_search_result(track, bill_user) for track in boost_popular(results['tracks']['items'])]
+        self.write({"results": results_list, "saldo": credit_ledger.cached_balance(bill_user.bill_key)})
 
 class MPDSearchHandler(BaseHandler):
     @tornado.web.authenticated
-    def post(self):
-        bill_user = BILLUser(self.current_user.decode(),check_code=False)
+    async def post(self):
+        bill_user = self.get_bill_user()
+
+        mpd_results = await mpd_search(self.request.body.decode())
+        self.write({"results": [mpd_search_result(track, bill_user) for track in mpd_results]})
+
+# Searches Spotify and the MPD library at the same time and streams the results
+# of each source as one JSON line (NDJSON) as soon as it is ready, so a slow
+# source does not hold back the other. A source that does not answer within
+# search_deadline seconds gets an error line instead; its reply still fills the
+# cache for the next search.
+#
+# Query arguments: sources=spotify,mpd (default both), cursor=<offset> and
+# limit=<results per source>. Every line has "next", the cursor of the next page
+# of that source, or null if there are no more results.
+class UnifiedSearchHandler(BaseHandler):
+    search_deadline = float(os.getenv("SEARCH_DEADLINE", 5))
+    default_limits = {"spotify": 10, "mpd": library_index.limit}
+    max_limit = 50   # Spotify's max page size
+
+    async def search(self, source, query, offset, limit, bill_user):
+        if source == "spotify":
+            results = await spotify_search(query, offset, limit)
+            tracks = results['tracks']['items']
+            line = {"results": [spotify_search_result(track, bill_user) for track in boost_popular(tracks)],
+                    "saldo": credit_ledger.cached_balance(bill_user.bill_key)}
+            more = results['tracks']['next'] is not None
+        else:
+            tracks = await mpd_search(query, offset, limit+1)   # One extra to see if there is a next page
+            more = len(tracks) > limit
+            tracks = tracks[:limit]
+            line = {"results": [mpd_search_result(track, bill_user) for track in tracks]}
+        line["next"] = offset+len(tracks) if more and tracks else None
+        return line
+
+    async def search_with_deadline(self, source, query, offset, limit, bill_user):
+        try:
+            line = await tornado.gen.with_timeout(timedelta(seconds=self.search_deadline),
+                                                  self.search(source, query, offset, limit, bill_user),
+                                                  quiet_exceptions=upstream_errors)
+        except tornado.util.TimeoutError:
+            print("Search in", source, "timed out:", query)
+            line = {"error": "Sökningen tog för lång tid", "results": []}
+        except Exception as e:
+            line = {"error": str(e), "results": []}
+        line["source"] = source
+        return line
+
+    @tornado.web.authenticated
+    async def post(self):
+        bill_user = self.get_bill_user()
 
-        mpdclient = mpd_connect()
-        results_list = []
-        for idx, track in enumerate(mpdclient.search("filename", self.request.body.decode())):
-            filename = track['file'].split("/")[-1] # Remove directory part to get only filename
+        query = self.request.body.decode()
+        if not query.strip():
+            return
+        sources = [source for source in self.get_argument("sources", "spotify,mpd").split(",") if source in self.default_limits]
+        try:
+            offset = max(0, int(self.get_argument("cursor", 0)))
+            limit = self.get_argument("limit", None)
+            limit = min(max(1, int(limit)), self.max_limit) if limit else None
+        except ValueError:
+            self.set_status(400)
+            self.write("Ogiltig cursor eller limit")
+            return
+
+        self.set_header("Content-Type", "application/x-ndjson")
+        self.set_header("Cache-Control", "no-cache")
+        searches = [self.search_with_deadline(source, query, offset, limit or self.default_limits[source], bill_user) for source in sources]
+        for search in asyncio.as_completed(searches):
+            self.write(json.dumps(await search)+"\n")
             try:
-                artist = track['artist']
-            except:
-                artist = ""
-
-            results_list.append( {
-                "name": filename,
-                "artist": artist,
-                "image": [{"url": "static/mp3_icon_600.png"}, {"url": "static/mp3_icon_600.png"}, {"url": "static/mp3_icon_64.png"}],
-                "id": track['file'],
-                "credits": get_song_cost(float(track['duration']), bill_user)
-            })
-
-        self.write({"results": results_list})
-
-class VolumeHandler(tornado.web.RequestHandler):
-    def get(self, volume):
+                await self.flush()
+            except StreamClosedError:   # Browser gave up, e.g. a new search was started
+                return
+
+class StatsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write({"track_cache": track_cache.stats(), "search_cache": search_cache.stats(), "handoff": handoff_scheduler.stats(), "login": login_guard.stats(), "credits": credit_ledger.stats(),
+                    "worker": {"id": worker_id, "leader": is_leader}, "history": play_history.stats(),
+                    "spotify_device": spotify_device.stats(), "control": control_dispatcher.stats(),
+                    "upstreams": upstream.stats(), "spotify_budget": spotify_budget.stats(),
+                    "spotify_token": spotify_auth.stats() if spotify_auth else None})
+
+class VolumeHandler(UpstreamErrorHandler):
+    async def get(self, volume):
+        volume = int(volume)
+        spotify_volume = spotify_control("volume", "volume", volume)
+        mpd_volume = control_dispatcher.submit("mpd", "volume", lambda: mpd_command("setvol", volume))
         try:
-            spotify_login().volume(int(volume), device_id=get_playback_device_id())
+            await spotify_volume
         except:
             pass
-        mpd_connect().setvol(int(volume))
-
+        await mpd_volume
+
+
+# Build response for current MPD status compatible with Spotify's API response
+def mpd_current_playback(mpdstatus, currentsong):
+    return {
+        'device': {
+            'name': playback_device_name,
+            'is_active': True,
+            'volume_percent': int(mpdstatus['volume']),
+        },
+        'progress_ms': int(float(mpdstatus['elapsed'])*1000),
+        'item': {
+            'name': currentsong['file'].split("/")[-1],
+            'artists': [
+                {'name': ""}
+            ],
+            'album': {
+                'images': [
+                    {'url': "static/mp3_icon_600.png"},
+                    {'url': "static/mp3_icon_600.png"},
+                    {'url': "static/mp3_icon_64.png"}
+                ]
+            },
+            'duration_ms': int(float(mpdstatus['duration'])*1000),
+            #'id': mpdstatus['songid'],
+            'id': currentsong['file'],
+            },
+        'is_playing': True
+    }
 
 class CurrentHandler(tornado.web.RequestHandler):
-    def get(self):
-
-        mpdclient = mpd_connect()
-        mpdstatus = mpdclient.status()
-
-
-        if mpdstatus['state'] == "play":
-            currentsong = mpdclient.currentsong()
-            current_mpd_playback = {   # Build response for current MPD status compatible with Spotify's API response
-                'device': {
-                    'name': playback_device_name,
-                    'is_active': True,
-                    'volume_percent': int(mpdstatus['volume']),
-                },
-                'progress_ms': int(float(mpdstatus['elapsed'])*1000),
-                'item': {
-                    'name': currentsong['file'].split("/")[-1],
-                    'artists': [
-                        {'name': ""}
-                    ],
-                    'album': {
-                        'images': [
-                            {'url': "static/mp3_icon_600.png"},
-                            {'url': "static/mp3_icon_600.png"},
-                            {'url': "static/mp3_icon_64.png"}
-                        ]
-                    },
-                    'duration_ms': int(float(mpdstatus['duration'])*1000),
-                    #'id': mpdstatus['songid'],
-                    'id': currentsong['file'],
-                    },
-                'is_playing': True
-            }
-            self.write(current_mpd_playback)
+    async def get(self):
+        # Served from the playback engine, which asks MPD/Spotify at most once per max_age for all clients
+        current_playback = await playback_engine.current_state(max_age=5)
+        if current_playback is not None:
+            self.write(current_playback)
         else:
-            current_playback = spotify_login().current_playback()
-            if current_playback is not None:
-                self.write(current_playback)
-            else:
-                #self.set_status(500)
-                self.write("No playback running")
-                return
+            #self.set_status(500)
+            self.write("No playback running")
+            return
 
 
 class MediaControlHandler(MainHandler):
     @tornado.web.authenticated
 
-    def post(self):
-        global current_track_type
-        try:
-            current_track_type
-        except:
-            current_track_type = None
-
+    async def post(self):
+        current_track_type = playback_engine.current_track_type
         print("current_track_type:", current_track_type)
 
+        # Play and pause replace each other if one is still waiting, prev is always sent
         if current_track_type == "spotify":
             if  (self.get_argument('action') == 'play'):
-                spotify_login().start_playback(device_id=get_playback_device_id())
+                await spotify_control("playstate", "start_playback")
             elif(self.get_argument('action') == 'pause'):
-                spotify_login().pause_playback(device_id=get_playback_device_id())
+                await spotify_control("playstate", "pause_playback")
             elif(self.get_argument('action') == 'prev'):
-                spotify_login().previous_track(device_id=get_playback_device_id())
+                await spotify_control("previous", "previous_track", coalesce=False)
             elif(self.get_argument('action') == 'next'):
                 pass
                 #spotify_login().next_track(device_id=get_playback_device_id())
         if current_track_type == "mpd":
-            mpdclient = mpd_connect()
             if  (self.get_argument('action') == 'play'):
-                mpdclient.pause(0)
+                await control_dispatcher.submit("mpd", "playstate", lambda: mpd_command("pause", 0))
             elif(self.get_argument('action') == 'pause'):
-                mpdclient.pause(1)
+                await control_dispatcher.submit("mpd", "playstate", lambda: mpd_command("pause", 1))
             elif(self.get_argument('action') == 'prev'):
-                mpdclient.previous()
+                await control_dispatcher.submit("mpd", "previous", lambda: mpd_command("previous"), coalesce=False)
+        playback_engine.wake()
 
 
-class QueueHandler(tornado.web.RequestHandler):
+# Ready once warm_up() is done, e.g. for a load balancer health check
+class ReadyHandler(tornado.web.RequestHandler):
     def get(self):
-        global queue, queue_maintenance_needed
-        queue_maintenance_needed = True
-        queue_maintenance()
-        self.write({"queue": queue})
-
+        if not warmed_up:
+            self.set_status(503)
+        self.write({"ready": warmed_up, "warm_up": warm_up_steps})
 
-last_queue_maintenance_run = datetime.min
-queue_maintenance_needed = False
-def queue_maintenance():
-    #last_queue_maintenance_run_handle = tornado.ioloop.IOLoop.current().call_later(30, queue_maintenance)
-    global last_queue_maintenance_run
-    global queue_maintenance_needed
-
-    if not queue_maintenance_needed:
-        return
-
-    if(datetime.now()-last_queue_maintenance_run < timedelta(seconds=25)):
-        print("queue_maintenance() skipping, last run", (datetime.now()-last_queue_maintenance_run).total_seconds(), "seconds ago")
-        return
+class MostPlayedHandler(tornado.web.RequestHandler):
+    def get(self):
+        limit = min(int(self.get_argument("limit", 20)), 100)
+        self.write({"tracks": play_history.most_played(limit)})
 
-    print("queue_maintenance() run, last run", (datetime.now()-last_queue_maintenance_run).total_seconds(), "seconds ago")
-    last_queue_maintenance_run = datetime.now()
+class QueueHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(queue.json())
+
+
+# Playback state machine. Decides what plays next and when to hand off between
+# MPD and Spotify. It runs a step whenever something happens (MPD player events,
+# enqueues, media control) and otherwise polls on a timer that gets shorter as
+# the current track nears its end.
+class PlaybackEngine:
+    mpd_handoff_lead = 45      # Seconds before the end of an MPD track when the next track is prepared
+    spotify_handoff_lead = 30  # Same for Spotify tracks
+    near_end_interval = 2      # Poll interval once we are within the lead time
+    max_interval = 30          # Poll interval when nothing is about to happen
+    stale_wait = 1             # Seconds /current waits for fresh state before serving the last known one
+
+    def __init__(self):
+        self.current_track_type = None  # "mpd", "spotify" or None
+        self.now_playing = None         # Response for /current, see current_state()
+        self.playing = None             # (QueueEntry, expected end in time.monotonic()) of the playing track
+        self.updated = 0                # When now_playing was read
+        self.failing = False            # Whether the last step failed, e.g. MPD or Spotify is down
+        self.near_end = False           # Whether the playing track is about to end, see poll_interval()
+        self.stepped = tornado.locks.Condition()
+        self.running = False
+        self.pending = False
+        self.timer = None
+
+    # Run a step as soon as possible
+    def wake(self):
+        if not is_leader:   # Only the leader plays, pass it on
+            tornado.ioloop.IOLoop.current().spawn_callback(send_command, {"op": "wake"})
+            return
+        tornado.ioloop.IOLoop.current().add_callback(self.tick)
+
+    def schedule(self, delay):
+        io_loop = tornado.ioloop.IOLoop.current()
+        if self.timer:
+            io_loop.remove_timeout(self.timer)
+            self.timer = None
+        if delay is not None:
+            self.timer = io_loop.call_later(delay, self.tick)
+
+    # Seconds until the next poll of a track with time_left seconds left
+    def poll_interval(self, time_left, lead):
+        self.near_end = time_left <= lead + self.near_end_interval
+        if self.near_end:
+            return self.near_end_interval
+        return min(self.max_interval, time_left - lead)
+
+    async def tick(self):
+        if not is_leader:   # Stepped down, see become_follower()
+            return
+        if self.running:   # Run once more when the current step is done
+            self.pending = True
+            return
 
-    global queue
-    global current_track_type
-    mpdclient = mpd_connect()
-    mpdstatus = mpdclient.status()
+        self.running = True
+        try:
+            delay = self.max_interval
+            self.pending = True
+            while self.pending:
+                self.pending = False
+                try:
+                    delay = await self.step()
+                    self.updated = time.monotonic()
+                    self.failing = False
+                except upstream_errors as e:
+                    print("Playback engine step failed:", e)
+                    self.failing = True
+                    delay = self.max_interval
+                except Exception:
+                    print(traceback.format_exc())
+                    self.failing = True
+                    delay = self.max_interval
+                publish_state()
+                self.stepped.notify_all()
+
+            if delay is None and state_broadcaster.clients:   # Keep pushing fresh state to open browsers
+                delay = self.max_interval
+            self.schedule(delay)
+        finally:
+            self.running = False
+
+    # What is playing, at most max_age seconds old. Concurrent callers share one
+    # step. The last known state is served if the step takes longer than
+    # stale_wait, or right away while the players are failing (stale while
+    # revalidate); the engine retries on its own then.
+    async def current_state(self, max_age):
+        if is_leader and time.monotonic() - self.updated > max_age:
+            if self.failing:
+                return self.now_playing
+            self.wake()
+            await self.stepped.wait(timeout=timedelta(seconds=self.stale_wait if self.updated else 10))
+        return self.now_playing
+
+    # Drop queued tracks up until and including the track that is playing now,
+    # returns the queue entry of that track if it was queued
+    def trim_queue(self, current_track_id):
+        removed = queue.trim_until(current_track_id)
+        if removed:
+            print("Cleared", len(removed), "items from queue up until", self.current_track_type, "id", current_track_id)
+            return removed[-1]
+        return None
+
+    # Record a track in the play history when it starts, and the previous one
+    # as skipped if it stopped well before its end
+    def track_playing(self, entry, time_left):
+        if not self.playing or self.playing[0].id != entry.id:
+            if self.playing and time.monotonic() < self.playing[1] - 10:
+                play_history.record("skip", self.playing[0])
+            play_history.record("start", entry)
+        self.playing = (entry, time.monotonic() + time_left)
+
+    # Look at what is playing, start or prepare the next track if needed, and
+    # return the number of seconds until we should look again (None = until woken)
+    async def step(self):
+        mpdstatus = await mpd_command("status")
+
+        # Case 1: mpd is playing
+        if mpdstatus['state'] == "play":
+            self.current_track_type = "mpd"
+            currentsong = await mpd_command("currentsong")
+            self.now_playing = mpd_current_playback(mpdstatus, currentsong)
+            current_track_id = currentsong['file']
+            entry = self.trim_queue(current_track_id)
+            handoff_scheduler.started(current_track_id, float(mpdstatus['elapsed']))
 
-    # Case 1: mpd is playing
-    if mpdstatus['state'] == "play":
-        # Trim queue variable up until and including currently playing track
-        current_track_id = mpdclient.currentsong()['file']
-        current_track_type = "mpd"
-        for i in range(len(queue)):
-            if(queue[i]['id'] == current_track_id):
-                print("Cleared", i+1, "items from queue up until mpd id",current_track_id)
-                queue = queue[i+1:]
-                break
+            # Time left of currently playing track
+            time_left = float(mpdstatus['duration']) - float(mpdstatus['elapsed'])
+            self.track_playing(entry or QueueEntry.from_mpd(currentsong), time_left)
+            head = self.next_entry()
+            if (head and head.type=="track" and time_left < self.mpd_handoff_lead):
+                self.arm_handoff(head, time_left)
+            else:
+                handoff_scheduler.cancel()
+                if (head and head.type=="mpd" and time_left < self.mpd_handoff_lead):
+                    print("Preparing next track:", head.type, head.id)
+                    await mpd_command("add", head.id)   # MPD plays it after the current one
+                    queue.handed_off(head)
 
-        # Time left of currently playing track
-        time_left = float(mpdstatus['duration']) - float(mpdstatus['elapsed'])
-        if (time_left < 45 and len(queue)!=0 and not queue[0]['in_queue']):
-            #queue = queue[1:] # Get rid of currently playing track
-            print("I will attempt at dealing with this piece of track:")
-            print(queue[0])
-            if (queue[0]['type']=="mpd"):     # mpd type
-                mpdclient.add(queue[0]['id'])
-            elif (queue[0]['type']=="track"): # Spotify type
-                print("Spotify playback queued in future: IOLoop.call_later("+str(time_left)+", spotify_start_playback_with, "+str(queue[0]['id'])+")")
-                tornado.ioloop.IOLoop.current().call_later(time_left, spotify_start_playback_with, queue[0]['id'])
-            queue[0]['in_queue'] = True
+            # Track changes are reported by MPD player events, polling is only needed to catch the handoff point
+            return self.poll_interval(time_left, self.mpd_handoff_lead)
 
+        # Near the end of a track this decides the handoff, which must not wait for searches
+        current_playback = await spotify_call(PLAYBACK if self.near_end else STATE, "current_playback")
+        self.now_playing = current_playback
 
-    else:
-        current_playback = spotify_login().current_playback()
+        # MPD paused by an admin, don't start anything else
+        if mpdstatus['state'] == "pause" and not (current_playback and current_playback['is_playing']):
+            self.current_track_type = "mpd"
+            handoff_scheduler.cancel()
+            return self.max_interval
 
         # Case 2: Nothing is playing
         if (current_playback == None):
-            if(len(queue)!=0 and not queue[0]['in_queue']):
-                print("Detected no playback running, but", len(queue), "tracks in queue. Force-starting playback...")
-                print("I will attempt at dealing with this piece of track:")
-                print(queue[0])
-                if (queue[0]['type']=="mpd"):     # mpd type
-                    mpd_start_playback_with(queue[0]['id'])
-                elif (queue[0]['type']=="track"): # Spotify type
-                    spotify_start_playback_with(queue[0]['id'])
-                queue[0]['in_queue'] = True
-            else:
-                # Put this app to sleep
-                print("Putting queue_maintenance() to sleep")
-                #tornado.ioloop.IOLoop.current().remove_timeout(last_queue_maintenance_run_handle)
-                queue_maintenance_needed = False
+            self.current_track_type = None
+            head = queue.head()
+            if(head and handoff_scheduler.armed()==head.id):
+                # The playing track ended before the scheduled handoff, start it right away
+                await handoff_scheduler.fire(ended=True)
+                return self.near_end_interval
+            if(head and not head.in_queue):
+                print("Detected no playback running, but", len(queue), "tracks in queue. Force-starting playback with", head.type, head.id)
+                if (head.type=="mpd"):     # mpd type
+                    await mpd_start_playback_with(head.id)
+                elif (head.type=="track"): # Spotify type
+                    await spotify_start_playback_with(head.id)
+                queue.handed_off(head)
+                return self.near_end_interval
+            elif(len(queue)!=0):   # Waiting for a scheduled handoff
+                return self.max_interval
+            return None   # Sleep until something is enqueued or MPD starts playing
+
+        # Case 3: Spotify is playing (or paused)
+        if current_playback['device']['name'] != playback_device_name:
+            print("Spotify-konto ej tillgängligt: Spotify-konto i användning på:", current_playback['device']['name'])
+            spotify_device.invalidate()   # Check the devices again before playing anything
+            return self.max_interval
+        if current_playback['device'].get('id'):
+            spotify_device.update(current_playback['device']['id'])
+
+        self.current_track_type = "spotify"
+        if current_playback['item'] is None:
+            handoff_scheduler.cancel()
+            return self.max_interval
+        entry = self.trim_queue(current_playback['item']['id'])
+        handoff_scheduler.started(current_playback['item']['id'], current_playback['progress_ms']/1000)
 
-
-        # Case 3: Spotify is playing
+        # Time left of currently playing track
+        time_left = float(current_playback['item']['duration_ms'] - current_playback['progress_ms']) / 1000
+        if not current_playback['is_playing']:
+            head = queue.head()
+            if head and handoff_scheduler.armed()==head.id and (time_left < 1 or current_playback['progress_ms'] == 0):
+                # Spotify reports a track that ended as paused, at its end or back at
+                # the start. It ended before the scheduled handoff, start it right away
+                await handoff_scheduler.fire(ended=True)
+                return self.near_end_interval
+        self.track_playing(entry or QueueEntry.from_spotify(current_playback['item']), time_left)
+
+        if not current_playback['is_playing']:   # Paused by an admin mid-track
+            handoff_scheduler.cancel()
+            return self.max_interval
+        head = self.next_entry()
+        if (head and head.type=="mpd" and time_left < self.spotify_handoff_lead):
+            self.arm_handoff(head, time_left)
         else:
-            try:
-                get_playback_device_id()
-            except Exception as e:
-                print("Spotify-konto ej tillgängligt")
-                print("Putting queue_maintenance() to sleep")
-                queue_maintenance_needed = False
+            handoff_scheduler.cancel()
+            if (head and head.type=="track" and time_left < self.spotify_handoff_lead):
+                print("Preparing next track:", head.type, head.id)
+                await spotify_device.call(lambda device_id: spotify_call(PLAYBACK, "add_to_queue", "spotify:track:"+head.id, device_id=device_id))
+                queue.handed_off(head)   # Spotify plays it after the current one
+
+        return self.poll_interval(time_left, self.spotify_handoff_lead)
+
+    # Queue head if it has not been handed to a player yet
+    def next_entry(self):
+        head = queue.head()
+        return head if head and not head.in_queue else None
+
+    # Switch players when the playing track ends, see handoff.py
+    def arm_handoff(self, entry, time_left):
+        async def start(prepared):
+            if queue.head() is not entry:   # Queue changed under our feet
                 return
+            if (entry.type=="track"):
+                await spotify_start_playback_with(entry.id, prepared)
+            else:
+                await mpd_start_playback_with(entry.id)
+            queue.handed_off(entry)
 
-            # Trim queue variable up until and including currently playing track
-            current_track_id = current_playback['item']['id']
-            current_track_type = "spotify"
-            for i in range(len(queue)):
-                if(queue[i]['id'] == current_track_id):
-                    print("Cleared", i+1, "items from queue up until spotify id",current_track_id)
-                    queue = queue[i+1:]
-                    break
-
-            # Time left of currently playing track
-            time_left = float(current_playback['item']['duration_ms'] - current_playback['progress_ms']) / 1000
-            if (time_left < 30 and len(queue)!=0 and not queue[0]['in_queue']):
-                #queue = queue[1:] # Get rid of currently playing track
-                print("I will attempt at dealing with this piece of track:")
-                print(queue[0])
-                if (queue[0]['type']=="mpd"):     # mpd type
-                    print("MPD playback queued in future: IOLoop.call_later("+str(time_left)+", mpd_start_playback_with, "+str(queue[0]['id'])+")")
-                    tornado.ioloop.IOLoop.current().call_later(time_left, mpd_start_playback_with, queue[0]['id'])
-                elif (queue[0]['type']=="track"): # Spotify type
-                    spotify_login().add_to_queue("spotify:track:"+queue[0]['id'], device_id=get_playback_device_id())
-
-def spotify_start_playback_with(song_url):
+        if (entry.type=="track"):
+            prepare = spotify_device.get
+        else:
+            prepare = lambda: mpd_command("ping")   # Make sure a pooled connection is alive
+        handoff_scheduler.arm(entry.id, time_left, start, prepare)
+
+handoff_scheduler = HandoffScheduler()
+playback_engine = PlaybackEngine()
+state_broadcaster = StateBroadcaster()
+published_queue_version = None
+
+metrics.gauge("kakeplay_queue_length", "Tracks in the play queue", lambda: len(queue))
+metrics.gauge("kakeplay_spotify_window_calls", "Spotify API calls sent in the last 30 s, see spotifybudget.py", lambda: len(spotify_budget.sent))
+metrics.gauge("kakeplay_event_stream_clients", "Browsers connected to /events", lambda: len(state_broadcaster.clients))
+
+# Push what is playing and the queue to browsers connected to /events
+def publish_state():
+    global published_queue_version
+    state_broadcaster.update("current", playback_engine.now_playing)
+    if queue.version != published_queue_version:
+        published_queue_version = queue.version
+        state_broadcaster.update("queue", queue.to_json())
+
+
+# After a restart, entries recovered from the journal may be marked as handed
+# to a player that has since lost them (e.g. MPD or Spotify restarted too).
+# Those are handed off again; the engine trims what has already played.
+async def reconcile_queue():
+    try:
+        mpd_files = {song['file'] for song in await mpd_command("playlistinfo")}
+    except Exception as e:
+        print("Reading MPD playlist failed:", e)
+        mpd_files = set()
+    try:
+        spotify_queue = await spotify_call(STATE, "queue")
+        spotify_ids = {item['id'] for item in spotify_queue['queue'] if item}
+    except Exception as e:
+        print("Reading Spotify queue failed:", e)
+        spotify_ids = set()
+
+    for entry in queue:
+        if entry.in_queue and entry.id not in (mpd_files if entry.type=="mpd" else spotify_ids):
+            print("Queued", entry.type, entry.id, "no longer queued in player, handing it off again")
+            entry.in_queue = False
+    playback_engine.wake()
+
+
+# Multi-process mode (WORKERS > 1), see shared.py. A single process is always the leader.
+shared_store = None
+is_leader = True
+if workers > 1:
+    shared_store = SharedStore.open(os.getenv("SHARED_STORE", "sqlite:kakeplay.db"), mysql_get_cursor)
+    is_leader = False
+    queue = SharedQueue(lambda command: upstream.run("store", shared_store.push_command, command))
+    credit_ledger = SharedCreditLedger(bill_client, shared_store, ttl=credit_ledger.ttl)
+worker_id = None
+lease_ttl = 10              # Seconds the leader lease is valid without renewal
+lease_expires = 0
+shared_sync_interval = 0.25 # Seconds between reading or publishing shared state
+applied_command = 0         # Leader: seq of the last command applied to the queue
+synced = {}                 # Leader: what was published last; follower: store versions loaded
+player_watcher = None       # Leader: MPDWatcher of player events
+
+metrics.gauge("kakeplay_leader", "1 if this worker runs the playback engine", lambda: int(is_leader))
+
+# Follower: pass a queue change or wake-up on to the leader
+async def send_command(command):
+    try:
+        await upstream.run("store", shared_store.push_command, command)
+    except Exception as e:
+        print("Forwarding", command['op'], "to the leader failed:", e)
+
+# Take or renew the leader lease. A leader that could not renew its lease in
+# time steps down and carries on as a follower.
+async def elect_leader():
+    global lease_expires
+    attempted = time.time()
+    try:
+        leader = await upstream.run("store", shared_store.acquire_lease, worker_id, lease_ttl)
+    except Exception as e:
+        print("Renewing leader lease failed:", e)
+        leader = False
+
+    if leader:
+        lease_expires = attempted + lease_ttl
+        if not is_leader:
+            await become_leader()
+    elif is_leader and time.time() > lease_expires - 1:
+        print("Worker", worker_id, "lost the leader lease")
+        become_follower()
+
+# Take over the queue the last leader published and start playing
+async def become_leader():
+    global is_leader, applied_command, player_watcher
+    states = await upstream.run("store", shared_store.states)
+    version, snapshot = states.get("queue", (0, {"seq": 0, "queue": []}))
+    queue.load(snapshot['queue'])
+    applied_command = snapshot['seq']
+    is_leader = True
+    print("Worker", worker_id, "is now the leader,", len(queue), "tracks in queue")
+
+    player_watcher = MPDWatcher(os.getenv("MPD_SERVER"), 6600, ["player"], mpd_changed)
+    player_watcher.start()
+    io_loop.add_callback(reconcile_queue)   # Wakes the playback engine when done
+
+# Stop playing, another worker may take over once the lease has expired. The
+# queue and what is playing are loaded from the store again as a follower.
+def become_follower():
+    global is_leader, player_watcher
+    is_leader = False
+    if player_watcher:
+        player_watcher.stop()
+        player_watcher = None
+    handoff_scheduler.cancel()
+    playback_engine.schedule(None)
+    synced.clear()
+
+# Leader: apply commands from followers, publish the queue and what is playing.
+# Follower: load what the leader published and push it to browsers.
+async def sync_shared_state():
+    global applied_command
+    try:
+        if is_leader:
+            commands = await upstream.run("store", shared_store.commands, applied_command)
+            for seq, command in commands:
+                apply_op(queue, command)
+                applied_command = seq
+            if commands:
+                playback_engine.wake()
+
+            if queue.version != synced.get("queue"):
+                version = queue.version
+                snapshot = {"seq": applied_command, "queue": [entry.to_record() for entry in queue]}
+                await upstream.run("store", shared_store.publish, "queue", snapshot)
+                synced["queue"] = version
+                await upstream.run("store", shared_store.delete_commands, snapshot['seq'])
+
+            current = {"now_playing": playback_engine.now_playing, "track_type": playback_engine.current_track_type}
+            if current != synced.get("current"):
+                await upstream.run("store", shared_store.publish, "current", current)
+                synced["current"] = current
+        else:
+            states = await upstream.run("store", shared_store.states)
+            if is_leader:   # Became leader while reading
+                return
+            for name, (version, value) in states.items():
+                if synced.get(name) == version:
+                    continue
+                synced[name] = version
+                if name == "queue":
+                    queue.load(value['queue'])
+                elif name == "current":
+                    playback_engine.now_playing = value['now_playing']
+                    playback_engine.current_track_type = value['track_type']
+            publish_state()
+    except Exception as e:
+        print("Syncing shared state failed:", e)
+
+
+# Called from the MPDWatcher thread with the list of changed MPD subsystems
+def mpd_changed(subsystems):
+    if "database" in subsystems:
+        io_loop.add_callback(refresh_library)
+    if "player" in subsystems:
+        io_loop.add_callback(playback_engine.tick)
+
+async def spotify_start_playback_with(song_url, playback_device_id=None):
     print("Running spotify_start_playback_with("+str(song_url)+")")
-    playback_device_id = get_playback_device_id()
-    spotify_login().repeat("off", playback_device_id)
-    spotify_login().shuffle("off", playback_device_id)
-    spotify_login().start_playback(device_id=get_playback_device_id(), uris=["spotify:track:"+song_url])
-
-def mpd_start_playback_with(song_url):
+    if playback_device_id:
+        spotify_device.update(playback_device_id)
+    # The device id may come from the cache, check that the account is not
+    # in use on another device before taking playback from it
+    current_playback = await spotify_call(PLAYBACK, "current_playback")
+    if current_playback is not None and current_playback['device']['name'] != playback_device_name:
+        spotify_device.invalidate()
+        raise Exception("Uppspelning misslyckades: Spotify-konto i användning på: "+current_playback['device']['name'])
+    async def start(device_id):
+        await spotify_call(PLAYBACK, "repeat", "off", device_id)
+        await spotify_call(PLAYBACK, "shuffle", "off", device_id)
+        await spotify_call(PLAYBACK, "start_playback", device_id=device_id, uris=["spotify:track:"+song_url])
+    await spotify_device.call(start)
+    playback_engine.wake()   # Spotify sends no events, have a look at the new track
+
+async def mpd_start_playback_with(song_url):
     print("Running mpd_start_playback_with("+str(song_url)+")")
-    mpdclient = mpd_connect()
-    mpdclient.add(song_url)
-    mpdclient.play()
+    await mpd_command("add", song_url)
+    await mpd_command("play")
+
+# Answers everything but /ready while warm_up() runs
+class WarmingUpHandler(tornado.web.RequestHandler):
+    def prepare(self):
+        self.set_status(503)
+        self.set_header("Retry-After", "5")
+        self.finish("Jukeboxen startar, försök igen om en stund")
+
+class Application(tornado.web.Application):
+    def find_handler(self, request, **kwargs):
+        if not warmed_up and request.path != "/ready":
+            return self.get_handler_delegate(request, WarmingUpHandler)
+        return super().find_handler(request, **kwargs)
 
 def make_app():
-    return tornado.web.Application([
+    return Application([
         (r"/", MainHandler),
         (r"/static/(.*)", tornado.web.StaticFileHandler, {'path': 'static'}),
         (r"/logout", LogoutHandler),
         (r"/play_track/(.*)", PlayHandler),
+        (r"/play_many", BulkPlayHandler),
         (r"/delete_track", DeleteHandler),
         (r"/search", SearchHandler),
         (r"/volume/(.*)", VolumeHandler),
         (r"/current", CurrentHandler),
         (r"/mediacontrol", MediaControlHandler),
         (r"/queue", QueueHandler),
+        (r"/most_played", MostPlayedHandler),
+        (r"/ready", ReadyHandler),
         (r"/mpdsearch", MPDSearchHandler),
+        (r"/search_all", UnifiedSearchHandler),
         (r"/mpd_play_track", MPDPlayHandler),
         (r"/settings", SettingsHandler),
+        (r"/stats", StatsHandler),
+        (r"/metrics", metrics.MetricsHandler),
+        (r"/events", EventsHandler, {"broadcaster": state_broadcaster}),
     ],
     debug = debug,
+    log_function = metrics.log_request,
     cookie_secret = os.getenv("TORNADO_COOKIE_SECRET"),
     login_url = "."
     )
 
-if __name__ == "__main__":
-    app = make_app()
-    app.listen(8888, "localhost")
-
-    #tornado.ioloop.IOLoop.current().call_later(5.0, queue_maintenance)
-    tornado.ioloop.PeriodicCallback(queue_maintenance, 30000).start()
+warm_up_timeout = float(os.getenv("WARM_UP_TIMEOUT", 30))
+warm_up_steps = {}   # Step -> "ok", "pending" or the error
+warmed_up = False
+
+# Do what the first requests would otherwise wait for: sign in to Spotify,
+# open the MPD connections, find the playback device and build the library
+# index. Called after start(), while the app already accepts connections. A step
+# that fails or takes longer than warm_up_timeout is left to the first request
+# that needs it. Until it is done only /ready is served.
+async def warm_up():
+    global warmed_up
+    async def spotify_session():
+        spotify_login()
+        if spotify_auth:   # Asks for the Spotify sign in on the first run
+            await upstream.run("spotify", spotify_auth.get_access_token, as_dict=False)
+            await refresh_spotify_token()
+    async def mpd_connections():
+        await asyncio.gather(*[mpd_command("ping") for i in range(mpd_pool.max_connections)])
+    async def playback_device():
+        await spotify_session_ready
+        await spotify_device.get()
+    async def library():
+        while not library_index.ready:
+            await asyncio.sleep(0.1)
+
+    async def step(name, coroutine):
+        warm_up_steps[name] = "pending"
+        try:
+            await tornado.gen.with_timeout(timedelta(seconds=warm_up_timeout), coroutine)
+            warm_up_steps[name] = "ok"
+        except tornado.util.TimeoutError:
+            warm_up_steps[name] = "timed out"
+        except Exception as e:
+            warm_up_steps[name] = str(e)
+        print("Warm-up:", name, warm_up_steps[name])
+
+    began = time.monotonic()
+    spotify_session_ready = asyncio.ensure_future(step("spotify_session", spotify_session()))
+    await asyncio.gather(spotify_session_ready, step("mpd_connections", mpd_connections()),
+                         step("playback_device", playback_device()), step("library_index", library()))
+    warmed_up = True
+    print("Warm-up done in %.1f s" % (time.monotonic() - began))
+
+# Start the background work (MPD keepalive and events, credit reconciling, the
+# queue journal and the playback engine) on the current IOLoop
+def start():
+    global io_loop, worker_id
+    tornado.ioloop.PeriodicCallback(mpd_keepalive, mpd_pool.keepalive_interval*1000).start()
+    tornado.ioloop.PeriodicCallback(refresh_spotify_token, 60*1000).start()
+    tornado.ioloop.PeriodicCallback(credit_ledger.reconcile, credit_ledger.ttl/2*1000).start()
+    play_history.start()
+    io_loop = tornado.ioloop.IOLoop.current()
+
+    if not shared_store:
+        queue_journal.load()
+        queue_journal.start()
+
+        MPDWatcher(os.getenv("MPD_SERVER"), 6600, ["database", "player"], mpd_changed).start()
+        io_loop.add_callback(reconcile_queue)   # Wakes the playback engine when done
+    else:
+        # The queue is kept in the shared store, player events are watched by the leader only
+        worker_id = socket.gethostname()+":"+str(os.getpid())
+        MPDWatcher(os.getenv("MPD_SERVER"), 6600, ["database"], mpd_changed).start()
+        tornado.ioloop.PeriodicCallback(elect_leader, lease_ttl/3*1000).start()
+        tornado.ioloop.PeriodicCallback(sync_shared_state, shared_sync_interval*1000).start()
+        tornado.ioloop.PeriodicCallback(expire_logins, 60*1000).start()
+        io_loop.add_callback(elect_leader)
 
+if __name__ == "__main__":
+    if workers > 1:
+        sockets = tornado.netutil.bind_sockets(8888, "localhost")
+        tornado.process.fork_processes(workers)   # Returns in each worker, restarts workers that die
+        tornado.httpserver.HTTPServer(make_app()).add_sockets(sockets)
+    else:
+        make_app().listen(8888, "localhost")
+    start()
+    tornado.ioloop.IOLoop.current().spawn_callback(warm_up)
     tornado.ioloop.IOLoop.current().start()
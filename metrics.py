@@ -0,0 +1,175 @@
+# In-process metrics in the Prometheus text format, served on /metrics: latency
+# histograms, error counts and in-flight gauges of upstream calls (recorded by
+# upstream.run), connections opened to upstreams, circuit breaker states, and
+# request timing per handler. Calls slower than SLOW_CALL_THRESHOLD seconds are also printed.
+#
+# Everything is kept in module globals behind one lock, as calls are recorded
+# both from the IOLoop and from upstream threads.
+
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import tornado.log
+import tornado.web
+
+
+slow_call_threshold = float(os.getenv("SLOW_CALL_THRESHOLD", 1))
+
+# Upper bounds of the latency buckets, in seconds
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(buckets)+1)   # Last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(buckets):
+            if seconds <= bound:
+                break
+        else:
+            i = len(buckets)
+        self.counts[i] += 1
+        self.sum += seconds
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(buckets + ("+Inf",), self.counts):
+            cumulative += count
+            yield name+"_bucket"+format_labels(labels + (("le", str(bound)),))+" "+str(cumulative)
+        yield name+"_sum"+format_labels(labels)+" "+repr(self.sum)
+        yield name+"_count"+format_labels(labels)+" "+str(cumulative)
+
+
+upstream_latency = defaultdict(Histogram)   # (upstream, call) -> Histogram
+upstream_errors = defaultdict(int)          # (upstream, call, exception class) -> count
+upstream_in_flight = defaultdict(int)       # upstream -> calls started but not finished
+upstream_connects = defaultdict(int)        # upstream -> connections opened
+upstream_rejected = defaultdict(int)        # upstream -> calls failed at once by an open circuit breaker
+breaker_states = {}                         # upstream -> 0 closed, 1 half-open, 2 open
+request_latency = defaultdict(Histogram)    # (handler, method, status) -> Histogram
+gauges = {}                                 # name -> (help, fn returning a number)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{"+",".join(key+'="'+str(value).replace("\\", "\\\\").replace('"', '\\"')+'"' for key, value in labels)+"}"
+
+
+# Record one upstream call, e.g. call_started("spotify") ... call_finished("spotify", "search", 0.2)
+def call_started(upstream):
+    with lock:
+        upstream_in_flight[upstream] += 1
+
+def call_finished(upstream, call, seconds, error=None):
+    with lock:
+        upstream_in_flight[upstream] -= 1
+        upstream_latency[(upstream, call)].observe(seconds)
+        if error is not None:
+            upstream_errors[(upstream, call, type(error).__name__)] += 1
+    if seconds >= slow_call_threshold:
+        print("Slow upstream call: %s %s took %.2f s%s" % (upstream, call, seconds, " and failed: "+str(error) if error is not None else ""))
+
+# Time the block as an upstream call, for calls that are not made with upstream.run
+@contextmanager
+def timed(upstream, call):
+    call_started(upstream)
+    start = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        call_finished(upstream, call, time.monotonic() - start, e)
+        raise
+    call_finished(upstream, call, time.monotonic() - start)
+
+def connected(upstream):
+    with lock:
+        upstream_connects[upstream] += 1
+
+def call_rejected(upstream):
+    with lock:
+        upstream_rejected[upstream] += 1
+
+def breaker_state(upstream, state):
+    with lock:
+        breaker_states[upstream] = ("closed", "half-open", "open").index(state)
+
+# Register a gauge read when /metrics is scraped, e.g. the queue length
+def gauge(name, help, fn):
+    gauges[name] = (help, fn)
+
+
+# Application log_function: time every request per handler, and write the
+# access log line like Tornado does without a log_function
+def log_request(handler):
+    status = handler.get_status()
+    seconds = handler.request.request_time()
+    with lock:
+        request_latency[(type(handler).__name__, handler.request.method, status)].observe(seconds)
+
+    if status < 400:
+        log_method = tornado.log.access_log.info
+    elif status < 500:
+        log_method = tornado.log.access_log.warning
+    else:
+        log_method = tornado.log.access_log.error
+    log_method("%d %s %.2fms", status, handler._request_summary(), 1000.0 * seconds)
+
+
+def render():
+    lines = []
+    def family(name, type, help):
+        lines.append("# HELP "+name+" "+help)
+        lines.append("# TYPE "+name+" "+type)
+
+    with lock:
+        family("kakeplay_upstream_call_seconds", "histogram", "Latency of upstream calls, including waiting for a free worker")
+        for (upstream, call), histogram in sorted(upstream_latency.items()):
+            lines.extend(histogram.lines("kakeplay_upstream_call_seconds", (("upstream", upstream), ("call", call))))
+
+        family("kakeplay_upstream_errors_total", "counter", "Upstream calls that raised, by exception class")
+        for (upstream, call, error), count in sorted(upstream_errors.items()):
+            lines.append("kakeplay_upstream_errors_total"+format_labels((("upstream", upstream), ("call", call), ("error", error)))+" "+str(count))
+
+        family("kakeplay_upstream_in_flight", "gauge", "Upstream calls started and not yet finished")
+        for upstream, count in sorted(upstream_in_flight.items()):
+            lines.append("kakeplay_upstream_in_flight"+format_labels((("upstream", upstream),))+" "+str(count))
+
+        family("kakeplay_upstream_connects_total", "counter", "Connections opened to upstream servers")
+        for upstream, count in sorted(upstream_connects.items()):
+            lines.append("kakeplay_upstream_connects_total"+format_labels((("upstream", upstream),))+" "+str(count))
+
+        family("kakeplay_upstream_rejected_total", "counter", "Upstream calls failed at once because the circuit breaker was open")
+        for upstream, count in sorted(upstream_rejected.items()):
+            lines.append("kakeplay_upstream_rejected_total"+format_labels((("upstream", upstream),))+" "+str(count))
+
+        family("kakeplay_upstream_breaker_state", "gauge", "Circuit breaker of the upstream: 0 closed, 1 half-open, 2 open")
+        for upstream, state in sorted(breaker_states.items()):
+            lines.append("kakeplay_upstream_breaker_state"+format_labels((("upstream", upstream),))+" "+str(state))
+
+        family("kakeplay_request_seconds", "histogram", "Time to serve HTTP requests, per handler")
+        for (handler, method, status), histogram in sorted(request_latency.items()):
+            lines.extend(histogram.lines("kakeplay_request_seconds", (("handler", handler), ("method", method), ("status", status))))
+
+    for name, (help, fn) in sorted(gauges.items()):
+        try:
+            value = fn()
+        except Exception:
+            continue
+        family(name, "gauge", help)
+        lines.append(name+" "+str(value))
+
+    return "\n".join(lines)+"\n"
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(render())
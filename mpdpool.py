@@ -0,0 +1,161 @@
+# Pool of persistent MPD connections. Connections are handed out to one thread
+# at a time (MPDClient is not thread safe), pinged while idle so MPD does not
+# drop them, and re-established transparently if MPD restarts. MPDWatcher keeps
+# a separate connection waiting for MPD idle events.
+
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from mpd import MPDClient, ConnectionError as MPDConnectionError
+
+import metrics
+
+
+# Commands that only read, and may be sent again if we don't know whether MPD got them
+read_commands = frozenset(["ping", "status", "currentsong", "playlistinfo", "listallinfo", "lsinfo", "search", "find", "stats"])
+
+
+class MPDPool:
+    def __init__(self, host, port=6600, max_connections=4, timeout=10, keepalive_interval=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.keepalive_interval = keepalive_interval
+        self.max_connections = max_connections
+        self.slots = threading.BoundedSemaphore(max_connections)  # Cap on open sockets
+        self.lock = threading.Lock()
+        self.idle = []  # (client, last_used) pairs ready for reuse
+
+    def _connect(self):
+        print("Opening MPD connection to", self.host)
+        client = MPDClient()
+        client.timeout = self.timeout
+        client.connect(self.host, self.port)
+        metrics.connected("mpd")
+        client.consume(1)   # Songs are removed from playlist after they played
+        return client
+
+    def _discard(self, client):
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+
+    def _checkout(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                client, last_used = self.idle.pop()
+
+            # Connections that sat idle for a while may have been closed by MPD
+            if time.monotonic() - last_used < self.keepalive_interval:
+                return client
+            try:
+                client.ping()
+                return client
+            except (MPDConnectionError, OSError):
+                self._discard(client)
+
+        return self._connect()
+
+    def _checkin(self, client):
+        with self.lock:
+            self.idle.append((client, time.monotonic()))
+
+    @contextmanager
+    def connection(self):
+        self.slots.acquire()
+        try:
+            client = self._checkout()
+            try:
+                yield client
+            except (MPDConnectionError, OSError):
+                self._discard(client)
+                raise
+            except Exception:
+                self._checkin(client)
+                raise
+            else:
+                self._checkin(client)
+        finally:
+            self.slots.release()
+
+    # Run fn(mpdclient) on a pooled connection. If the connection turns out to be
+    # dead (e.g. MPD was restarted) the pool is cleared, and with retry=True the
+    # call is made again on a fresh connection. Only pass retry=True for
+    # commands that may run twice (see read_commands): MPD may have run the
+    # command before the connection broke. Timeouts are never retried.
+    def run(self, fn, retry=False):
+        try:
+            with self.connection() as client:
+                return fn(client)
+        except (MPDConnectionError, OSError) as e:
+            print("MPD connection lost (" + str(e) + ")" + (", reconnecting" if retry else ""))
+            self.clear()
+            if not retry or isinstance(e, socket.timeout):
+                raise
+            with self.connection() as client:
+                return fn(client)
+
+    # Ping connections that have been idle for too long, drop the ones that are dead
+    def keepalive(self):
+        with self.lock:
+            stale = [entry for entry in self.idle if time.monotonic() - entry[1] >= self.keepalive_interval]
+            self.idle = [entry for entry in self.idle if entry not in stale]
+
+        for client, last_used in stale:
+            try:
+                client.ping()
+                self._checkin(client)
+            except (MPDConnectionError, OSError):
+                self._discard(client)
+
+    # Close all idle connections
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for client, last_used in idle:
+            self._discard(client)
+
+
+# Thread that blocks in MPD "idle" on its own connection and calls
+# on_change(subsystems) with the list of changed subsystems, e.g. ["player"].
+# After every (re)connect on_change is called with all watched subsystems,
+# since events may have been missed while disconnected.
+class MPDWatcher(threading.Thread):
+    def __init__(self, host, port, subsystems, on_change, retry_interval=5):
+        super().__init__(name="mpd-watcher", daemon=True)
+        self.host = host
+        self.port = port
+        self.subsystems = list(subsystems)
+        self.on_change = on_change
+        self.retry_interval = retry_interval
+        self.stopped = threading.Event()
+
+    # Stop reporting changes. The thread ends when its idle returns or times out.
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            client = MPDClient()
+            client.timeout = 10
+            try:
+                client.connect(self.host, self.port)
+                self.on_change(self.subsystems)
+                while True:
+                    changed = client.idle(*self.subsystems)
+                    if self.stopped.is_set():
+                        return
+                    self.on_change(changed)
+            except Exception as e:
+                print("MPD watcher disconnected:", e)
+            finally:
+                try:
+                    client.disconnect()
+                except Exception:
+                    pass
+            self.stopped.wait(self.retry_interval)
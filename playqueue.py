@@ -0,0 +1,149 @@
+# The play queue. Entries are small records with only what the UI and the
+# playback engine need, indexed by track id so that deleting a track and
+# trimming the queue up to the playing track don't scan the whole queue. The
+# JSON served on /queue is cached until the queue changes. Changes are recorded
+# in a journal (see journal.py) if one is attached.
+
+import itertools
+import json
+from collections import OrderedDict
+
+
+class QueueEntry:
+    __slots__ = ("key", "id", "type", "name", "artist", "image", "duration", "user", "cost", "in_queue")
+
+    def __init__(self, id, type, name, artist, image, duration, user=None, cost=0):
+        self.key = None       # Unique within the queue, set by PlayQueue
+        self.id = id          # Spotify track id or MPD file
+        self.type = type      # "track" (Spotify) or "mpd"
+        self.name = name
+        self.artist = artist
+        self.image = image    # Small cover image URL
+        self.duration = duration
+        self.user = user      # bill_key of the user who enqueued it
+        self.cost = cost      # Credits the user paid
+        self.in_queue = False # Handed to the player already
+
+    @classmethod
+    def from_spotify(cls, track, user=None, cost=0):
+        images = track['album']['images']
+        return cls(track['id'], "track", track['name'], track['artists'][0]['name'] if track['artists'] else "",
+                   images[-1]['url'] if images else "", float(track['duration_ms'])/1000, user, cost)
+
+    @classmethod
+    def from_mpd(cls, song, user=None, cost=0):
+        return cls(song['file'], "mpd", song['file'].split("/")[-1], song.get('artist', ""),  # Only filename, no directory
+                   "static/mp3_icon_64.png", float(song.get('duration', 0)), user, cost)
+
+    def to_json(self):
+        return {"id": self.id, "type": self.type, "name": self.name, "artist": self.artist, "image": self.image}
+
+    # Everything but the key, for the journal
+    def to_record(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__ if slot != "key"}
+
+    @classmethod
+    def from_record(cls, record):
+        entry = cls(record['id'], record['type'], record['name'], record['artist'], record['image'],
+                    record['duration'], record['user'], record['cost'])
+        entry.in_queue = record['in_queue']
+        return entry
+
+
+class PlayQueue:
+    def __init__(self):
+        self.entries = OrderedDict()  # key -> QueueEntry, in play order
+        self.by_id = {}               # track id -> keys of its entries, in play order
+        self.keys = itertools.count()
+        self.version = 0              # Bumped on every change
+        self.json_cache = None
+        self.journal = None
+
+    def record(self, op, **data):
+        if self.journal:
+            self.journal.record(op, **data)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(list(self.entries.values()))
+
+    def changed(self):
+        self.version += 1
+        self.json_cache = None
+
+    # First entry, or None if the queue is empty
+    def head(self):
+        for entry in self.entries.values():
+            return entry
+        return None
+
+    def append(self, entry):
+        entry.key = next(self.keys)
+        self.entries[entry.key] = entry
+        self.by_id.setdefault(entry.id, []).append(entry.key)
+        self.changed()
+        self.record("enqueue", entry=entry.to_record())
+        return entry
+
+    # The entry has been handed to a player, which will play it next
+    def handed_off(self, entry):
+        entry.in_queue = True
+        self.record("handoff", id=entry.id)
+
+    def _unlink(self, entry):
+        keys = self.by_id[entry.id]
+        keys.remove(entry.key)
+        if not keys:
+            del self.by_id[entry.id]
+
+    # Remove the first entry of track_id, returns the entry or None
+    def delete(self, track_id):
+        keys = self.by_id.get(track_id)
+        if not keys:
+            return None
+        entry = self.entries.pop(keys[0])
+        self._unlink(entry)
+        self.changed()
+        self.record("delete", id=track_id)
+        return entry
+
+    # Remove entries up until and including the first entry of track_id,
+    # returns the removed entries (none if track_id is not queued)
+    def trim_until(self, track_id):
+        keys = self.by_id.get(track_id)
+        if not keys:
+            return []
+
+        last = keys[0]
+        removed = []
+        while True:
+            key, entry = self.entries.popitem(last=False)
+            self._unlink(entry)
+            removed.append(entry)
+            if key == last:
+                break
+        self.changed()
+        self.record("trim", id=track_id)
+        return removed
+
+    # Wait until the changes so far are stored. They are journaled in the
+    # background, so there is nothing to wait for here, see SharedQueue.
+    async def saved(self):
+        pass
+
+    def clear(self):
+        self.entries.clear()
+        self.by_id.clear()
+        self.changed()
+        self.record("clear")
+
+    def to_json(self):
+        return [entry.to_json() for entry in self.entries.values()]
+
+    # Encoded {"queue": [...]} response, regenerated only after changes
+    def json(self):
+        if self.json_cache is None:
+            self.json_cache = json.dumps({"queue": self.to_json()}, separators=(",", ":"))
+        return self.json_cache
@@ -0,0 +1,120 @@
+# Pushes shared state (now playing, queue) to every open browser over
+# Server-Sent Events. The state is produced once on the server and clients get
+# a full snapshot when they connect and small JSON merge patches (RFC 7386)
+# after that, so upstream load does not grow with the number of clients.
+
+import json
+
+import tornado.ioloop
+import tornado.queues
+import tornado.web
+from tornado.iostream import StreamClosedError
+
+
+# JSON merge patch turning old into new, or None if they are equal
+def merge_patch(old, new):
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return None if old == new else new
+
+    patch = {}
+    for key in old:
+        if key not in new:
+            patch[key] = None
+    for key, value in new.items():
+        if key not in old:
+            patch[key] = value
+        elif old[key] != value:
+            if isinstance(value, dict) and isinstance(old[key], dict):
+                patch[key] = merge_patch(old[key], value)
+            else:
+                patch[key] = value
+    return patch or None
+
+
+class StateBroadcaster:
+    def __init__(self, keepalive_interval=25):
+        self.state = {}
+        self.version = 0
+        self.clients = set()
+        self.keepalive = tornado.ioloop.PeriodicCallback(self.ping, keepalive_interval*1000)
+
+    # Set state[key] and send the change to all clients
+    def update(self, key, value):
+        # Round trip through JSON so that comparisons see what clients see
+        value = json.loads(json.dumps(value))
+        if key in self.state and self.state[key] == value:
+            return
+        patch = merge_patch(self.state[key], value) if key in self.state else value
+
+        self.state[key] = value
+        self.version += 1
+        self.send("patch", {"v": self.version, "patch": {key: patch}})
+
+    def snapshot(self):
+        return {"v": self.version, "state": self.state}
+
+    def send(self, event, data):
+        message = "event: "+event+"\ndata: "+json.dumps(data, separators=(",", ":"))+"\n\n"
+        for client in list(self.clients):
+            client.push(message)
+
+    # Comment line that keeps proxies from closing idle streams
+    def ping(self):
+        for client in list(self.clients):
+            client.push(":\n\n")
+
+    def subscribe(self, client):
+        self.clients.add(client)
+        if not self.keepalive.is_running():
+            self.keepalive.start()
+
+    def unsubscribe(self, client):
+        self.clients.discard(client)
+        if not self.clients:
+            self.keepalive.stop()
+
+
+# text/event-stream endpoint, give it the broadcaster as handler argument
+class EventsHandler(tornado.web.RequestHandler):
+    max_pending = 100   # Drop clients that fall this many messages behind
+
+    def initialize(self, broadcaster):
+        self.broadcaster = broadcaster
+        self.messages = tornado.queues.Queue(maxsize=self.max_pending)
+        self.closed = False
+
+    def push(self, message):
+        try:
+            self.messages.put_nowait(message)
+        except tornado.queues.QueueFull:
+            print("Dropping slow event stream client", self.request.remote_ip)
+            self.on_connection_close()
+            self.request.connection.close()
+
+    async def get(self):
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("X-Accel-Buffering", "no")  # Tell nginx not to buffer the stream
+
+        self.broadcaster.subscribe(self)
+        try:
+            self.write("retry: 5000\nevent: snapshot\ndata: "+json.dumps(self.broadcaster.snapshot(), separators=(",", ":"))+"\n\n")
+            await self.flush()
+            while not self.closed:
+                message = await self.messages.get()
+                if self.closed:
+                    break
+                self.write(message)
+                await self.flush()
+        except StreamClosedError:
+            pass
+        finally:
+            self.broadcaster.unsubscribe(self)
+
+    def on_connection_close(self):
+        self.closed = True
+        self.broadcaster.unsubscribe(self)
+        try:
+            self.messages.put_nowait("")   # Wake up get()
+        except tornado.queues.QueueFull:
+            pass
@@ -0,0 +1,60 @@
+# In-memory lookups of who a logged in user is, so that requests don't have to
+# read the adminkeys file or ask BILL on every hit.
+
+import os
+import time
+from collections import OrderedDict
+
+
+# Set of admin BILL keys, one per line in the adminkeys file. The file is
+# re-read when its mtime changes, which is checked at most every check_interval seconds.
+class AdminKeys:
+    def __init__(self, path='adminkeys', check_interval=5):
+        self.path = path
+        self.check_interval = check_interval
+        self.keys = frozenset()
+        self.mtime = None
+        self.checked = 0
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            self.keys = frozenset()
+            self.mtime = None
+            return
+
+        if mtime != self.mtime:
+            with open(self.path, 'r') as f:
+                self.keys = frozenset(line.strip() for line in f if line.strip())
+            self.mtime = mtime
+            print("Loaded", len(self.keys), "admin keys from", self.path)
+
+    def __contains__(self, bill_key):
+        if time.monotonic() - self.checked > self.check_interval:
+            self.checked = time.monotonic()
+            self.reload()
+        return bill_key in self.keys
+
+
+# LRU cache of user objects keyed by the bill key from the secure cookie
+class UserCache:
+    def __init__(self, factory, max_size=1000):
+        self.factory = factory
+        self.max_size = max_size
+        self.users = OrderedDict()
+
+    def get(self, bill_key):
+        if bill_key in self.users:
+            self.users.move_to_end(bill_key)
+            return self.users[bill_key]
+
+        user = self.factory(bill_key)
+        self.put(bill_key, user)
+        return user
+
+    def put(self, bill_key, user):
+        self.users[bill_key] = user
+        self.users.move_to_end(bill_key)
+        while len(self.users) > self.max_size:
+            self.users.popitem(last=False)
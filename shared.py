@@ -0,0 +1,300 @@
+# State shared between worker processes when the jukebox runs with WORKERS > 1.
+#
+# One worker holds a lease in the store and is the leader: it owns the play
+# queue and runs the playback engine like a single process does. All workers
+# serve pages, search and enqueueing. Queue changes are sent to the leader as
+# rows in a commands table, and followers serve the queue and what is playing
+# from the state the leader publishes in the store.
+#
+# Credit balances and reservations (SharedCreditLedger) and the login rate
+# limit are kept in the store too, so that they hold across workers.
+#
+# The store is SQLite (one file, for workers on one machine) or the MySQL
+# database of mysql_get_cursor(). All methods of SharedStore block, run them
+# in the "store" upstream pool.
+
+import json
+import sqlite3
+import time
+
+import tornado.gen
+import tornado.ioloop
+
+import upstream
+from ledger import CreditLedger, Reservation
+from playqueue import PlayQueue, QueueEntry
+
+
+class SharedStore:
+    def __init__(self, cursor, placeholder="?", serial="INTEGER PRIMARY KEY AUTOINCREMENT", text="TEXT"):
+        self.cursor = cursor            # Returns a cursor on an autocommit connection
+        self.placeholder = placeholder
+        self.serial = serial
+        self.text = text
+        self.created = False
+
+    @classmethod
+    def sqlite(cls, path):
+        connection = None
+        def cursor():
+            nonlocal connection
+            if connection is None:   # Opened in the worker, never shared across fork()
+                connection = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+            return connection.cursor()
+        return cls(cursor)
+
+    @classmethod
+    def mysql(cls, cursor):
+        return cls(cursor, "%s", "BIGINT AUTO_INCREMENT PRIMARY KEY", "MEDIUMTEXT")
+
+    # Store for the SHARED_STORE setting: "sqlite:<path>" or "mysql"
+    @classmethod
+    def open(cls, url, mysql_cursor):
+        if url == "mysql":
+            return cls.mysql(mysql_cursor)
+        if url.startswith("sqlite:"):
+            return cls.sqlite(url[len("sqlite:"):])
+        raise ValueError("Unknown SHARED_STORE "+url)
+
+    def execute(self, sql, args=()):
+        if not self.created:
+            self.create_tables()
+            self.created = True
+        cursor = self.cursor()
+        cursor.execute(sql.replace("?", self.placeholder), args)
+        return cursor
+
+    def create_tables(self):
+        cursor = self.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS kakeplay_state (name VARCHAR(64) PRIMARY KEY, value "+self.text+", version BIGINT)")
+        cursor.execute("CREATE TABLE IF NOT EXISTS kakeplay_commands (seq "+self.serial+", command "+self.text+")")
+        cursor.execute("CREATE TABLE IF NOT EXISTS kakeplay_leader (name VARCHAR(64) PRIMARY KEY, holder VARCHAR(255), expires DOUBLE PRECISION)")
+        cursor.execute("CREATE TABLE IF NOT EXISTS kakeplay_credits (bill_key VARCHAR(16) PRIMARY KEY, balance BIGINT, held BIGINT, "
+                       "fetched DOUBLE PRECISION, version BIGINT, debiting INT)")
+        cursor.execute("CREATE TABLE IF NOT EXISTS kakeplay_logins (ip VARCHAR(64) PRIMARY KEY, next DOUBLE PRECISION)")
+
+    # Published state: name -> (version, value)
+    def states(self):
+        return {name: (version, json.loads(value)) for name, value, version in self.execute("SELECT name, value, version FROM kakeplay_state").fetchall()}
+
+    # Publish value under name. Only the leader publishes, so there is no race
+    # between the update and the insert.
+    def publish(self, name, value):
+        value = json.dumps(value, separators=(",", ":"))
+        if self.execute("UPDATE kakeplay_state SET value=?, version=version+1 WHERE name=?", (value, name)).rowcount == 0:
+            self.execute("INSERT INTO kakeplay_state (name, value, version) VALUES (?, ?, 1)", (name, value))
+
+    def push_command(self, command):
+        self.execute("INSERT INTO kakeplay_commands (command) VALUES (?)", (json.dumps(command, separators=(",", ":")),))
+
+    # Commands after seq, as (seq, command) in the order they were pushed
+    def commands(self, after):
+        rows = self.execute("SELECT seq, command FROM kakeplay_commands WHERE seq > ? ORDER BY seq", (after,)).fetchall()
+        return [(seq, json.loads(command)) for seq, command in rows]
+
+    # Drop commands before seq. The one with seq itself is kept, so that MySQL never hands
+    # out its seq again after a restart (InnoDB may reset AUTO_INCREMENT to
+    # max(seq)+1).
+    def delete_commands(self, upto):
+        self.execute("DELETE FROM kakeplay_commands WHERE seq < ?", (upto,))
+
+    # Take or renew the leader lease for ttl seconds, returns whether holder has it
+    def acquire_lease(self, holder, ttl):
+        now = time.time()
+        if self.execute("UPDATE kakeplay_leader SET holder=?, expires=? WHERE name='leader' AND (holder=? OR expires<?)",
+                        (holder, now+ttl, holder, now)).rowcount:
+            return True
+        try:
+            self.execute("INSERT INTO kakeplay_leader (name, holder, expires) VALUES ('leader', ?, ?)", (holder, now+ttl))
+            return True
+        except Exception as e:
+            if type(e).__name__ != "IntegrityError":
+                raise
+            return False   # Row exists and someone else holds the lease
+
+    # Credit account of bill_key as (balance, held, fetched, version, debiting),
+    # None if there is none yet
+    def credit_account(self, bill_key):
+        return self.execute("SELECT balance, held, fetched, version, debiting FROM kakeplay_credits WHERE bill_key=?", (bill_key,)).fetchone()
+
+    # bill_key -> (balance, held, fetched, version, debiting) of the accounts of bill_keys that exist
+    def credit_accounts(self, bill_keys):
+        if not bill_keys:
+            return {}
+        rows = self.execute("SELECT bill_key, balance, held, fetched, version, debiting FROM kakeplay_credits WHERE bill_key IN ("+
+                            ",".join("?"*len(bill_keys))+")", tuple(bill_keys)).fetchall()
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    # Store a balance read from BILL, unless a debit was being written when
+    # the read started (account is the credit_account() read before it, None
+    # if there was none) or has been written since
+    def set_credit_balance(self, bill_key, balance, account):
+        if account is not None:
+            balance_was, held, fetched, version, debiting = account
+            if debiting <= 0:   # Also if a lost store update left it below 0
+                self.execute("UPDATE kakeplay_credits SET balance=?, fetched=? WHERE bill_key=? AND version=? AND debiting<=0",
+                             (balance, time.time(), bill_key, version))
+            return
+        try:
+            self.execute("INSERT INTO kakeplay_credits (bill_key, balance, held, fetched, version, debiting) VALUES (?, ?, 0, ?, 0, 0)",
+                         (bill_key, balance, time.time()))
+        except Exception as e:
+            if type(e).__name__ != "IntegrityError":
+                raise   # Otherwise another worker created it meanwhile
+
+    # Hold amount credits if the balance covers them, returns whether it did.
+    # One statement, so two workers can not both pass.
+    def hold_credits(self, bill_key, amount):
+        return self.execute("UPDATE kakeplay_credits SET held=held+? WHERE bill_key=? AND balance-held>=?", (amount, bill_key, amount)).rowcount == 1
+
+    def update_credits(self, bill_key, held=0, balance=0, version=0, debiting=0, stale=False):
+        self.execute("UPDATE kakeplay_credits SET held=held+?, balance=balance+?, version=version+?, debiting=debiting+?"+
+                     (", fetched=0" if stale else "")+" WHERE bill_key=?", (held, balance, version, debiting, bill_key))
+
+    # Forget accounts nobody has used for idle_timeout seconds
+    def expire_credits(self, idle_timeout):
+        self.execute("DELETE FROM kakeplay_credits WHERE held=0 AND fetched<?", (time.time()-idle_timeout,))
+
+    # Forget IPs that have all their login attempts left
+    def expire_logins(self):
+        self.execute("DELETE FROM kakeplay_logins WHERE next<?", (time.time(),))
+
+    # Login rate limit of RateLimiter, shared by the workers: ip may try once
+    # every 1/rate seconds, with burst attempts at once. Kept as the time when
+    # ip has its next attempt, returns whether ip may try now.
+    def allow_login(self, ip, rate, burst):
+        now = time.time()
+        if self.execute("UPDATE kakeplay_logins SET next=(CASE WHEN next>? THEN next ELSE ? END)+? WHERE ip=? AND next<=?",
+                        (now, now, 1/rate, ip, now+(burst-1)/rate)).rowcount:
+            return True
+        try:
+            self.execute("INSERT INTO kakeplay_logins (ip, next) VALUES (?, ?)", (ip, now+1/rate))
+            return True
+        except Exception as e:
+            if type(e).__name__ != "IntegrityError":
+                raise
+            return False   # Row exists and ip has no attempts left
+
+
+# The play queue in multi-process mode. Changes made by handlers are sent to
+# the leader with send(command), a coroutine function, and saved() waits for
+# the sends. The leader applies them with journal.apply_op() in the order they
+# reached the store, whichever worker made them, and publishes the queue, which
+# followers load(). Trims and handoffs are made by the leader's playback engine
+# and change the queue directly.
+class SharedQueue(PlayQueue):
+    def __init__(self, send):
+        super().__init__()
+        self.send = send
+        self.sending = []
+
+    def _send(self, command):
+        self.sending = [future for future in self.sending if not future.done()]
+        self.sending.append(tornado.gen.convert_yielded(self.send(command)))
+
+    async def saved(self):
+        sending, self.sending = self.sending, []
+        for future in sending:
+            await future
+
+    def load(self, records):
+        PlayQueue.clear(self)
+        for record in records:
+            PlayQueue.append(self, QueueEntry.from_record(record))
+
+    def append(self, entry):
+        self._send({"op": "enqueue", "entry": entry.to_record()})
+        return entry
+
+    def delete(self, track_id):
+        for entry in self:
+            if entry.id == track_id:
+                self._send({"op": "delete", "id": track_id})
+                return entry
+        return None
+
+    def clear(self):
+        self._send({"op": "clear"})
+
+
+# CreditLedger with the balances and reservations in the store, so that a
+# reservation made by one worker is seen by all. Debits are still written to
+# BILL by the worker that committed them.
+class SharedCreditLedger(CreditLedger):
+    def __init__(self, bill_client, store, **kwargs):
+        super().__init__(bill_client, **kwargs)
+        self.store = store
+        self.available = {}   # bill_key -> available credits last seen, for cached_balance()
+
+    def cached_balance(self, bill_key):
+        return self.available.get(bill_key)
+
+    async def refresh(self, bill_key, row=None):
+        self.account(bill_key)   # Active, see reconcile()
+        balance = await upstream.run("bill", self.bill_client.get_credits, bill_key)
+        await upstream.run("store", self.store.set_credit_balance, bill_key, balance, row)
+
+    async def balance(self, bill_key):
+        self.account(bill_key)
+        row = await upstream.run("store", self.store.credit_account, bill_key)
+        if row is None or time.time() - row[2] > self.ttl:
+            await self.refresh(bill_key, row)
+            row = await upstream.run("store", self.store.credit_account, bill_key)
+        balance, held, fetched, version, debiting = row
+        self.available[bill_key] = balance - held
+        return balance - held
+
+    async def reserve(self, bill_key, amount):
+        available = await self.balance(bill_key)
+        if amount == 0:
+            return Reservation(bill_key, amount) if available >= 0 else None
+        if not await upstream.run("store", self.store.hold_credits, bill_key, amount):
+            return None
+        self.available[bill_key] = available - amount
+        return Reservation(bill_key, amount)
+
+    def release(self, reservation):
+        if reservation.done:
+            return
+        reservation.done = True
+        if reservation.amount:
+            tornado.ioloop.IOLoop.current().spawn_callback(self._update, reservation.bill_key, held=-reservation.amount)
+
+    async def _update(self, bill_key, **changes):
+        try:
+            await upstream.run("store", self.store.update_credits, bill_key, **changes)
+        except Exception as e:
+            print("Updating credits of", bill_key, "in the shared store failed:", e)
+
+    async def debit_started(self, reservation):
+        await self._update(reservation.bill_key, version=1, debiting=1)
+
+    async def debit_done(self, reservation, written):
+        if written is None:
+            await self._update(reservation.bill_key, version=1, debiting=-1)
+        elif written:
+            await self._update(reservation.bill_key, held=-reservation.amount, balance=-reservation.amount, version=1, debiting=-1)
+        else:
+            await self._update(reservation.bill_key, held=-reservation.amount, version=1, debiting=-1, stale=True)
+
+    # Re-read balances of this worker's active users from BILL, forget users that have gone away
+    async def reconcile(self):
+        now = time.monotonic()
+        for bill_key, account in list(self.accounts.items()):
+            if now - account.last_seen > self.idle_timeout:
+                del self.accounts[bill_key]
+                self.available.pop(bill_key, None)
+        try:
+            await upstream.run("store", self.store.expire_credits, self.idle_timeout)
+
+            rows = await upstream.run("store", self.store.credit_accounts, list(self.accounts))
+            stale = [(bill_key, rows.get(bill_key)) for bill_key in self.accounts
+                     if bill_key not in rows or time.time() - rows[bill_key][2] > self.ttl/2]
+            if not stale:
+                return
+            balances = await upstream.run("bill", self.bill_client.get_credits_many, [bill_key for bill_key, row in stale])
+            for (bill_key, row), balance in zip(stale, balances):
+                await upstream.run("store", self.store.set_credit_balance, bill_key, balance, row)
+        except Exception as e:
+            print("Reconciling credit balances failed:", e)
@@ -0,0 +1,58 @@
+# Spotify OAuth token handling. spotipy refreshes the access token inline in
+# whichever API call first finds it (nearly) expired, reading the token file
+# from disk on every call. Here the token is kept in memory, refreshed in the
+# background well before it expires (see refresh_if_expiring), and concurrent
+# callers that do find it expired wait for one refresh instead of each making
+# their own.
+
+import threading
+import time
+
+from spotipy.cache_handler import CacheFileHandler
+from spotipy.oauth2 import SpotifyOAuth
+
+
+# Token file (.cache by default) read once and then served from memory
+class TokenCache(CacheFileHandler):
+    def __init__(self, cache_path=None):
+        super().__init__(cache_path)
+        self.token_info = None
+        self.loaded = False
+
+    def get_cached_token(self):
+        if not self.loaded:
+            self.token_info = super().get_cached_token()
+            self.loaded = True
+        return self.token_info
+
+    def save_token_to_cache(self, token_info):
+        self.token_info = token_info
+        self.loaded = True
+        super().save_token_to_cache(token_info)
+
+
+class RefreshingOAuth(SpotifyOAuth):
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("cache_handler", TokenCache())
+        super().__init__(*args, **kwargs)
+        self.refresh_lock = threading.Lock()
+        self.refreshes = 0
+
+    # Refresh the access token if it expires within margin seconds. Blocks,
+    # and callers arriving during a refresh get its result.
+    def refresh_if_expiring(self, margin):
+        with self.refresh_lock:
+            token_info = self.cache_handler.get_cached_token()
+            if token_info is None or token_info["expires_at"] - time.time() >= margin:
+                return token_info
+            print("Refreshing Spotify access token")
+            self.refreshes += 1
+            return super().refresh_access_token(token_info["refresh_token"])
+
+    # Called by spotipy when the token expires within a minute
+    def refresh_access_token(self, refresh_token):
+        return self.refresh_if_expiring(60)
+
+    def stats(self):
+        token_info = self.cache_handler.get_cached_token()
+        return {"expires_in": int(token_info["expires_at"] - time.time()) if token_info else None, "refreshes": self.refreshes}
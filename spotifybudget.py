@@ -0,0 +1,190 @@
+# All Spotify Web API calls go through SpotifyBudget, which keeps us under
+# Spotify's rate limit and makes sure that playback never waits for searches.
+#
+# - Calls are sent as they come until Spotify answers 429 with Retry-After (it counts
+#   calls in a rolling 30 second window, and does not publish the limit).
+#   Nothing is then sent until its Retry-After has passed, and the call is
+#   retried then if it can wait that long.
+# - After a 429, at most allowed calls are sent per window, a bit below what
+#   was sent in the window that got the 429, and allowed is raised by a tenth
+#   for every window without a 429. Each priority may only fill its share of
+#   allowed, so the last part of it is always left for playback. budget, if
+#   given, caps allowed from the start.
+# - Identical read calls (searches, track lookups, current playback...) that
+#   are waiting or in flight share one request.
+# - Waiting calls are sent highest priority first. A call that has waited
+#   longer than max_wait for its priority fails with SpotifyBusy.
+
+import heapq
+import itertools
+import math
+import time
+from collections import deque
+
+import tornado.concurrent
+import tornado.ioloop
+
+
+# Priorities, most important first
+PLAYBACK = 0   # Starting tracks, handoffs, queueing the next track, finding the device
+CONTROL = 1    # Volume and play/pause from users, enqueueing
+STATE = 2      # What is playing, for the playback engine and /current
+SEARCH = 3     # Searches and metadata for bulk enqueues
+
+# Share of the budget calls of each priority may fill
+shares = {PLAYBACK: 1.0, CONTROL: 0.9, STATE: 0.8, SEARCH: 0.6}
+
+# Seconds a call may wait to be sent, including after a 429
+max_wait = {PLAYBACK: 30, CONTROL: 10, STATE: 10, SEARCH: 5}
+
+# Calls without side effects, identical ones are sent only once
+read_methods = {"search", "track", "tracks", "album_tracks", "playlist_items", "current_playback", "devices", "queue"}
+
+
+class SpotifyBusy(Exception):
+    def __init__(self):
+        super().__init__("Spotify är upptaget, försök igen om en stund")
+
+
+class SpotifyCall:
+    __slots__ = ("priority", "method", "args", "kwargs", "key", "future", "deadline", "started")
+
+    def __init__(self, priority, method, args, kwargs, key):
+        self.priority = priority
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.future = tornado.concurrent.Future()
+        self.deadline = time.monotonic() + max_wait[priority]
+        self.started = False
+
+
+class SpotifyBudget:
+    def __init__(self, send, budget=math.inf, window=30, max_in_flight=8, min_allowed=10):
+        self.send = send                  # Coroutine function send(method, *args, **kwargs) making the API call
+        self.budget = budget              # Max calls per window, unlimited by default
+        self.allowed = budget             # Calls per window for now, lowered on 429
+        self.min_allowed = min_allowed
+        self.adjusted = 0                 # When allowed was last changed
+        self.window = window
+        self.max_in_flight = max_in_flight
+        self.sent = deque()               # time.monotonic() of calls sent within the window
+        self.waiting = []                 # Heap of (priority, seq, SpotifyCall)
+        self.seq = itertools.count()
+        self.calls = {}                   # Key -> SpotifyCall waiting or in flight, for read calls
+        self.in_flight = 0
+        self.blocked_until = 0            # No calls before this, from Retry-After
+        self.timer = None
+        self.deduplicated = 0
+        self.rate_limited = 0
+        self.expired = 0
+        self.sent_total = {priority: 0 for priority in shares}
+
+    # Make spotipy call method(*args, **kwargs) with the given priority, e.g.
+    # await budget.call(SEARCH, "search", q="abba", limit=10)
+    def call(self, priority, method, *args, **kwargs):
+        key = None
+        if method in read_methods:
+            key = repr((method, args, sorted(kwargs.items())))
+            call = self.calls.get(key)
+            if call:
+                self.deduplicated += 1
+                if priority < call.priority and not call.started:   # Someone needs it sooner
+                    call.priority = priority
+                    call.deadline = max(call.deadline, time.monotonic() + max_wait[priority])
+                    heapq.heappush(self.waiting, (priority, next(self.seq), call))
+                    self._dispatch()
+                return call.future
+
+        call = SpotifyCall(priority, method, args, kwargs, key)
+        if key:
+            self.calls[key] = call
+        heapq.heappush(self.waiting, (priority, next(self.seq), call))
+        self._dispatch()
+        return call.future
+
+    def _finish(self, call, result=None, error=None):
+        if call.key and self.calls.get(call.key) is call:
+            del self.calls[call.key]
+        if error is not None:
+            call.future.set_exception(error)
+        else:
+            call.future.set_result(result)
+
+    # Send what the budget allows, fail calls that waited too long
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.sent and self.sent[0] <= now - self.window:
+            self.sent.popleft()
+        if self.allowed < self.budget and now - self.adjusted >= self.window:
+            self.allowed = min(self.budget, self.allowed * 1.1)
+            self.adjusted = now
+
+        for priority, seq, call in self.waiting:
+            if not call.started and not call.future.done() and now >= call.deadline:
+                self.expired += 1
+                self._finish(call, error=SpotifyBusy())
+
+        while self.waiting and self.in_flight < self.max_in_flight:
+            priority, seq, call = self.waiting[0]
+            if call.started or call.future.done() or priority != call.priority:   # Sent, failed or moved up
+                heapq.heappop(self.waiting)
+                continue
+            if now < self.blocked_until or len(self.sent) >= self.allowed * shares[priority]:
+                break   # Calls behind it have lower priority and can't go either
+            heapq.heappop(self.waiting)
+            call.started = True
+            self.sent.append(now)
+            self.sent_total[priority] += 1
+            self.in_flight += 1
+            tornado.ioloop.IOLoop.current().spawn_callback(self._run, call)
+
+        self._schedule(now)
+
+    # Run _dispatch() again when the budget frees up or a waiting call expires
+    def _schedule(self, now):
+        io_loop = tornado.ioloop.IOLoop.current()
+        if self.timer:
+            io_loop.remove_timeout(self.timer)
+            self.timer = None
+        waiting = [call for priority, seq, call in self.waiting if not call.started and not call.future.done()]
+        if not waiting:
+            return
+        at = min(call.deadline for call in waiting)
+        if self.blocked_until > now:
+            at = min(at, self.blocked_until)
+        elif self.sent:
+            at = min(at, self.sent[0] + self.window)
+        self.timer = io_loop.call_at(io_loop.time() + max(0, at - now), self._dispatch)
+
+    async def _run(self, call):
+        try:
+            result = await self.send(call.method, *call.args, **call.kwargs)
+        except Exception as e:
+            # Only a 429 with Retry-After is Spotify rate limiting us. spotipy also
+            # raises 429 "Max Retries" when its retries of 5xx answers run out,
+            # that is an outage for the circuit breaker (see main.py).
+            retry_after = (getattr(e, "headers", None) or {}).get("Retry-After") if getattr(e, "http_status", None) == 429 else None
+            if retry_after:
+                retry_after = float(retry_after)
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+                self.allowed = max(self.min_allowed, min(self.allowed, len(self.sent)) * 0.8)
+                self.adjusted = time.monotonic()
+                self.rate_limited += 1
+                print("Spotify rate limit reached, no calls for", retry_after, "s")
+                if self.blocked_until < call.deadline:   # Send it again when allowed
+                    call.started = False
+                    heapq.heappush(self.waiting, (call.priority, next(self.seq), call))
+                    return
+            self._finish(call, error=e)
+        else:
+            self._finish(call, result)
+        finally:
+            self.in_flight -= 1
+            self._dispatch()
+
+    def stats(self):
+        return {"window_calls": len(self.sent), "budget": round(self.allowed) if self.allowed < math.inf else None, "waiting": sum(1 for priority, seq, call in self.waiting if not call.started and not call.future.done() and priority == call.priority), "in_flight": self.in_flight,
+                "blocked": max(0, round(self.blocked_until - time.monotonic(), 1)), "deduplicated": self.deduplicated,
+                "rate_limited": self.rate_limited, "expired": self.expired, "sent": self.sent_total}
@@ -37,49 +37,78 @@ $("#searchform").submit(function(event) {
     $("#mp3-results").html("");
   });
 
-  // Search Spotify
+  // Search Spotify and MP3 at the same time, each source is rendered as soon as its results arrive
   $( "#spotify-results" ).html("");
-  $.post( "search", $("input").first().val())
-    .done(function(data) {
-      for(var key in data['results']) {
-        //$( ".result" ).append('<a href="" id="'+data['results'][key]['id']+'" class="tracklink">'
-        $( "#spotify-results" ).append('<div class="songresult">'
-        +'<img class="songresult_img" src="'+data['results'][key]['image'][2]['url']+'" />'
-        +'<div class="credits credits_search">'+data['results'][key]['credits'] + '</div>'
-        +'<a href="play_track/'+data['results'][key]['id'] + '" class="tracklink" data-credits="'+data['results'][key]['credits']+'">'
-        +'<div class="songtitle" style="font-weight: bold;">'+data['results'][key]['name'] + "</div>"
-        +'<div class="songartist">'+data['results'][key]['artist'] + '</div>'
-        +'<div style="clear: left;"'
-        + "</a></div>" );
+  $( "#mp3-results" ).html("");
+  search($("input").first().val(), "spotify,mpd", 0);
+});
+
+var searchController = null;
+
+// POST a search to search_all and render the result lines (NDJSON) as they are streamed
+function search(query, sources, cursor) {
+  if(searchController && cursor == 0)
+    searchController.abort();   // A new search replaces the one still running
+  var controller = new AbortController();
+  if(cursor == 0)
+    searchController = controller;
+
+  fetch("search_all?sources="+sources+"&cursor="+cursor, {method: "POST", body: query, credentials: "same-origin", signal: controller.signal})
+    .then(function(response) {
+      if(!response.ok)
+        return response.text().then(function(text) { alert(text); });
+
+      var reader = response.body.getReader();
+      var decoder = new TextDecoder();
+      var buffered = "";
+      function read() {
+        return reader.read().then(function(chunk) {
+          buffered += decoder.decode(chunk.value || new Uint8Array(), {stream: !chunk.done});
+          var lines = buffered.split("\n");
+          buffered = lines.pop();
+          lines.forEach(function(line) {
+            if(line != "")
+              renderSearchResults(query, JSON.parse(line));
+          });
+          if(!chunk.done)
+            return read();
+        });
       }
+      return read();
     })
-    .fail(function(data) {
-      if(data != "")
-        alert(data['responseText']);
+    .catch(function(error) {
+      if(error.name != "AbortError")
+        alert(error);
     });
+}
 
+function renderSearchResults(query, data) {
+  var target = data['source'] == "spotify" ? "#spotify-results" : "#mp3-results";
+  var link = data['source'] == "spotify" ? "play_track/" : "mpd_play_track?url=";
+  $(target+" .moreresults").remove();
 
-    // Search MP3
-    $( "#mp3-results" ).html("");
-    $.post( "mpdsearch", $("input").first().val())
-      .done(function(data) {
-        for(var key in data['results']) {
-          //$( ".result" ).append('<a href="" id="'+data['results'][key]['id']+'" class="tracklink">'
-          $( "#mp3-results" ).append('<div class="songresult">'
-          +'<img class="songresult_img" src="'+data['results'][key]['image'][2]['url']+'" />'
-          +'<div class="credits credits_search">'+data['results'][key]['credits'] + '</div>'
-          +'<a href="mpd_play_track?url='+data['results'][key]['id'] + '" class="tracklink" data-credits="'+data['results'][key]['credits']+'">'
-          +'<div class="songtitle" style="font-weight: bold;">'+data['results'][key]['name'] + "</div>"
-          +'<div class="songartist">'+data['results'][key]['artist'] + '</div>'
-          +'<div style="clear: left;"'
-          + "</a></div>" );
-        }
-      })
-      .fail(function(data) {
-        if(data != "")
-          alert(data['responseText']);
-      });
-});
+  if(data['saldo'] != null)
+    $('#credit_saldo').html(data['saldo']);
+  if(data['error'])
+    $( target ).append('<div class="songresult">'+data['error']+'</div>');
+  for(var key in data['results']) {
+    $( target ).append('<div class="songresult">'
+    +'<img class="songresult_img" src="'+data['results'][key]['image'][2]['url']+'" />'
+    +'<div class="credits credits_search">'+data['results'][key]['credits'] + '</div>'
+    +'<a href="'+link+data['results'][key]['id'] + '" class="tracklink" data-credits="'+data['results'][key]['credits']+'">'
+    +'<div class="songtitle" style="font-weight: bold;">'+data['results'][key]['name'] + "</div>"
+    +'<div class="songartist">'+data['results'][key]['artist'] + '</div>'
+    +'<div style="clear: left;"'
+    + "</a></div>" );
+  }
+  if(data['next'] != null) {
+    $( target ).append('<div class="songresult moreresults" style="text-align: center; cursor: pointer;">Visa fler</div>');
+    $(target+" .moreresults").click(function() {
+      $(this).remove();
+      search(query, data['source'], data['next']);
+    });
+  }
+}
 
 $("#volume").change(function(event) {
   $("#volumeindicator").html($("#volume").val());
@@ -100,20 +129,22 @@ $(document).on('click','.deletesongbtn',function(e){
 
 
 function updateQueue() {
-  $( ".queue" ).html("");
   $.get( "queue")
-    .done(function(data) {
-      for(var key in data['queue']) {
-        //$( ".result" ).append('<a href="" id="'+data['results'][key]['id']+'" class="tracklink">'
-        $( ".queue" ).append('<div class="songresult">'
-        +'<img class="songresult_img" src="'+data['queue'][key]['album']['images'][2]['url']+'" />'
-        +'<div class="deletesongbtn credits_search" data-songid="'+data['queue'][key]['id']+'" style="cursor: pointer;"><i class="fas fa-trash"></i></div>'
-        +'<div class="songtitle" style="font-weight: bold;">'+data['queue'][key]['name'] + "</div>"
-        +'<div class="songartist">'+data['queue'][key]['artists'][0]['name'] + '</div>'
-        +'<div style="clear: left;"'
-        + "</div>" );
-      }
-    });
+    .done(renderQueue);
+}
+
+function renderQueue(data) {
+  $( ".queue" ).html("");
+  for(var key in data['queue']) {
+    //$( ".result" ).append('<a href="" id="'+data['results'][key]['id']+'" class="tracklink">'
+    $( ".queue" ).append('<div class="songresult">'
+    +'<img class="songresult_img" src="'+data['queue'][key]['image']+'" />'
+    +'<div class="deletesongbtn credits_search" data-songid="'+data['queue'][key]['id']+'" style="cursor: pointer;"><i class="fas fa-trash"></i></div>'
+    +'<div class="songtitle" style="font-weight: bold;">'+data['queue'][key]['name'] + "</div>"
+    +'<div class="songartist">'+data['queue'][key]['artist'] + '</div>'
+    +'<div style="clear: left;"'
+    + "</div>" );
+  }
 }
 updateQueue();
 
@@ -124,35 +155,110 @@ var track_id=false;
 function updateCurrent() {
   $.get("current")
     .done(function(data) {
-      var volume = data['device']['volume_percent'];
-      pos = Math.round(data['progress_ms']/1000);
-      playing = data['is_playing'];
-      var track_len = Math.round(data['item']['duration_ms']/1000);
-      var track_name = data['item']['name'];
-      var track_artist = data['item']['artists'][0]['name'];
-      var devicename = data['device']['name'];
-      var imagesrc = data['item']['album']['images'][0]['url'];
-      if (track_id != data['item']['id']) {
-        track_id = data['item']['id'];
-        updateQueue();
-      }
+      renderCurrent(data);
 
-      if(devicename == SPOTIFY_PLAYBACK_DEVICE_NAME) {
-        $("#volumeindicator").html(volume);
-        $("#volume").val(volume);
-        $("#currentlyPlaying").html('<img src="'+ imagesrc +'" style="width: 100%; max-width: 300px;"></img><br>');
-        $("#currentlyPlaying").append(track_artist + ' - ' + track_name + ' (<span id="pos">'+ secondsToMinutes(pos) +'</span>/' + secondsToMinutes(track_len) + ')');
+      if(pushActive)  // Server pushes changes, no need to poll
+        return;
+      if(!data['item']) {  // Nothing playing
+        timer = setTimeout(updateCurrent, 10000);
+        return;
       }
-
+      var track_len = Math.round(data['item']['duration_ms']/1000);
       var nextUpdateIn = Math.min( 60000, (track_len-pos)*1000+2000  );
       if(nextUpdateIn<5000) {
-        console.log("nextUpdateIn "+str(nextUpdateIn)+", setting to 5000");
+        console.log("nextUpdateIn "+nextUpdateIn+", setting to 5000");
         nextUpdateIn = 5000;
       }
       timer = setTimeout(updateCurrent, nextUpdateIn);
     });
 }
+
+function renderCurrent(data) {
+  if(!data || !data['item'])  // Nothing playing
+    return;
+  var volume = data['device']['volume_percent'];
+  pos = Math.round(data['progress_ms']/1000);
+  playing = data['is_playing'];
+  var track_len = Math.round(data['item']['duration_ms']/1000);
+  var track_name = data['item']['name'];
+  var track_artist = data['item']['artists'][0]['name'];
+  var devicename = data['device']['name'];
+  var imagesrc = data['item']['album']['images'][0]['url'];
+  if (track_id != data['item']['id']) {
+    track_id = data['item']['id'];
+    if(!pushActive)
+      updateQueue();
+  }
+
+  if(devicename == SPOTIFY_PLAYBACK_DEVICE_NAME) {
+    $("#volumeindicator").html(volume);
+    $("#volume").val(volume);
+    $("#currentlyPlaying").html('<img src="'+ imagesrc +'" style="width: 100%; max-width: 300px;"></img><br>');
+    $("#currentlyPlaying").append(track_artist + ' - ' + track_name + ' (<span id="pos">'+ secondsToMinutes(pos) +'</span>/' + secondsToMinutes(track_len) + ')');
+  }
+}
 var timer = setTimeout(updateCurrent, 0);
+
+// Server push of now playing and queue. Falls back to polling above if the
+// browser has no EventSource or the stream can not be kept open.
+var pushActive = false;
+var pushState = {};
+var pushVersion = 0;
+
+// Apply a JSON merge patch (RFC 7386)
+function mergePatch(target, patch) {
+  if(patch === null || typeof patch !== 'object' || Array.isArray(patch))
+    return patch;
+  if(target === null || typeof target !== 'object' || Array.isArray(target))
+    target = {};
+  for(var key in patch) {
+    if(patch[key] === null)
+      delete target[key];
+    else
+      target[key] = mergePatch(target[key], patch[key]);
+  }
+  return target;
+}
+
+function startPush() {
+  if(!window.EventSource)
+    return;
+  var source = new EventSource("events");
+
+  source.addEventListener('snapshot', function(e) {
+    var data = JSON.parse(e.data);
+    pushState = data['state'];
+    pushVersion = data['v'];
+    pushActive = true;
+    window.clearTimeout(timer);
+    renderCurrent(pushState['current']);
+    if('queue' in pushState)
+      renderQueue({queue: pushState['queue']});
+  });
+
+  source.addEventListener('patch', function(e) {
+    var data = JSON.parse(e.data);
+    if(data['v'] != pushVersion+1) {  // Missed something, reconnect to get a new snapshot
+      source.close();
+      startPush();
+      return;
+    }
+    pushVersion = data['v'];
+    pushState = mergePatch(pushState, data['patch']);
+    if('current' in data['patch'])
+      renderCurrent(pushState['current']);
+    if('queue' in data['patch'])
+      renderQueue({queue: pushState['queue']});
+  });
+
+  source.onerror = function() {
+    if(source.readyState == EventSource.CLOSED && pushActive) {  // Gave up, go back to polling
+      pushActive = false;
+      timer = setTimeout(updateCurrent, 1000);
+    }
+  };
+}
+startPush();
 setTimeout(proceedTrackPos, 1000);
 proceedtrackpos_last_timestamp = Date.now();
 
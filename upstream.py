@@ -0,0 +1,173 @@
+# Blocking upstream calls (Spotify, MPD, BILL, MySQL) are run in thread pools
+# so that one slow reply never stalls the Tornado IOLoop. Every upstream gets
+# its own bounded pool, which also caps how many calls we have in flight to it.
+#
+# Calls are given up after a deadline per upstream (the thread may still be
+# stuck, but nobody waits for it), and every upstream has a circuit breaker:
+# after a number of outages in a row (timeouts, connection errors) calls fail
+# at once for a while instead of queueing behind a hung server, then one trial
+# call is let through to see whether it is back.
+
+import asyncio
+import os
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado.ioloop
+
+import metrics
+
+
+# Max concurrent calls per upstream, override with e.g. UPSTREAM_LIMIT_SPOTIFY=8 in .env
+default_limits = {
+    "spotify": 8,
+    "mpd": 4,
+    "bill": 4,
+    "mysql": 2,
+    "library": 2,   # Not an upstream, but searching/updating the MPD library index is CPU heavy
+    "journal": 1,   # Queue journal writes, see journal.py
+    "store": 1,     # Shared store of multi-process mode, see shared.py
+}
+
+# Seconds to wait for a call, including waiting for a free worker, override
+# with e.g. UPSTREAM_DEADLINE_MPD=5 in .env. Keys can also be (upstream, call).
+# None waits forever.
+default_deadlines = {
+    "spotify": 15,
+    "mpd": 5,
+    ("mpd", "listallinfo"): 60,   # The whole library
+    "bill": 10,
+    "mysql": 10,
+    "store": 5,
+}
+
+# Exceptions other than OSError that mean an upstream is down, e.g.
+# outage_checks["mpd"] = lambda e: isinstance(e, mpd.ConnectionError)
+outage_checks = {}
+
+breaker_failures = int(os.getenv("UPSTREAM_BREAKER_FAILURES", 5))        # Outages in a row that open a breaker
+breaker_reset_timeout = float(os.getenv("UPSTREAM_BREAKER_RESET", 30))   # Seconds before a trial call is let through
+
+executors = {}
+breakers = {}
+
+
+# Raised by run() when the deadline has passed. Subclasses of OSError, so
+# callers that retry on network errors (e.g. the credit ledger) retry these too.
+class UpstreamTimeout(TimeoutError):
+    pass
+
+# Raised by run() without calling the upstream while its circuit breaker is open
+class UpstreamUnavailable(ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name, failures=5, reset_timeout=30):
+        self.name = name
+        self.failures = failures            # Outages in a row that open the breaker
+        self.reset_timeout = reset_timeout  # Seconds the breaker stays open
+        self.state = "closed"               # "closed", "open" or "half-open"
+        self.outages = 0
+        self.opened = 0
+        self.trial = False                  # A trial call is in flight while half-open
+        self.opens = 0
+        self.rejected = 0
+
+    def _set_state(self, state):
+        if state != self.state:
+            print("Circuit breaker of", self.name, "is now", state)
+            self.state = state
+            metrics.breaker_state(self.name, state)
+
+    # Whether a call may be made now
+    def allow(self):
+        if self.state == "open" and time.monotonic() - self.opened >= self.reset_timeout:
+            self._set_state("half-open")
+        if self.state == "closed" or (self.state == "half-open" and not self.trial):
+            self.trial = self.state == "half-open"
+            return True
+        self.rejected += 1
+        metrics.call_rejected(self.name)
+        return False
+
+    # The upstream answered, even if with an error of its own
+    def succeeded(self):
+        self.outages = 0
+        self.trial = False
+        self._set_state("closed")
+
+    def failed(self):
+        self.outages += 1
+        self.trial = False
+        if self.state == "half-open" or (self.state == "closed" and self.outages >= self.failures):
+            self.opened = time.monotonic()
+            self.opens += 1
+            self._set_state("open")
+
+    def stats(self):
+        return {"state": self.state, "outages": self.outages, "opens": self.opens, "rejected": self.rejected}
+
+
+def get_executor(name):
+    if name not in executors:
+        limit = int(os.getenv("UPSTREAM_LIMIT_"+name.upper(), default_limits.get(name, 2)))
+        executors[name] = ThreadPoolExecutor(max_workers=limit, thread_name_prefix="upstream-"+name)
+    return executors[name]
+
+
+def get_breaker(name):
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(name, breaker_failures, breaker_reset_timeout)
+    return breakers[name]
+
+
+def get_deadline(name, call):
+    deadline = os.getenv("UPSTREAM_DEADLINE_"+name.upper())
+    if deadline:
+        return float(deadline)
+    return default_deadlines.get((name, call), default_deadlines.get(name))
+
+
+def is_outage(name, error):
+    return isinstance(error, OSError) or outage_checks.get(name, lambda e: False)(error)
+
+
+# Run fn(*args, **kwargs) in the pool of the given upstream and wait for the
+# result. The call is recorded in metrics.py under the name of fn.
+async def run(name, fn, *args, **kwargs):
+    return await run_as(name, getattr(fn, "__name__", "call"), fn, *args, **kwargs)
+
+
+# Same as run(), recorded in metrics.py as the given call, e.g. the MPD command
+async def run_as(name, call, fn, *args, **kwargs):
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise UpstreamUnavailable(name+" är inte tillgänglig just nu")
+
+    metrics.call_started(name)
+    start = time.monotonic()
+    try:
+        future = tornado.ioloop.IOLoop.current().run_in_executor(get_executor(name), functools.partial(fn, *args, **kwargs))
+        try:
+            # Cancelling drops the call if it is still waiting for a worker
+            result = await asyncio.wait_for(future, get_deadline(name, call))
+        except asyncio.TimeoutError:
+            if not future.cancelled():   # fn itself timed out, e.g. on a socket
+                raise
+            raise UpstreamTimeout(name+" svarade inte i tid ("+call+")") from None
+    except Exception as e:
+        metrics.call_finished(name, call, time.monotonic() - start, e)
+        if is_outage(name, e):
+            breaker.failed()
+        else:
+            breaker.succeeded()
+        raise
+    metrics.call_finished(name, call, time.monotonic() - start)
+    breaker.succeeded()
+    return result
+
+
+def stats():
+    return {name: breaker.stats() for name, breaker in sorted(breakers.items())}